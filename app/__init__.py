@@ -4,6 +4,9 @@ from flask_cors import CORS
 from config import config
 from .models import db
 from .prefs import Prefs
+from .notify import Notifier
+from .auth import jwt_data, init_auth
+from .cache import init_cache
 
 
 def create_app(config_name):
@@ -14,7 +17,10 @@ def create_app(config_name):
     config[config_name].init_app(app)
     db.init_app(app)
 
-    JWTManager(app)
+    jwt = JWTManager(app)
+    jwt.jwt_data_loader(jwt_data)
+    init_auth(app)
+    init_cache(app)
 
     return app
 
@@ -26,6 +32,26 @@ def create_prefs(app):
     app.register_blueprint(pref_api_blueprint, url_prefix="/api/prefs")
 
 
+def start_listener(app):
+    '''Listen for changes made by other instances so cached data can be dropped'''
+    if app.config.get('NOTIFY_LISTEN'):
+        Notifier.start(app)
+
+
+def start_log_sink(app):
+    '''Write the Twilio webhooks' logs in the background instead of before responding'''
+    if app.config.get('LOG_SINK_ENABLED'):
+        from .twilio_api.logsink import LogSink
+        LogSink.start(app)
+
+
+def start_spool(app):
+    '''Keep webhook writes in a local file while the database is unavailable, and replay them'''
+    if app.config.get('SPOOL_PATH'):
+        from .twilio_api.spool import Spool
+        Spool.start(app)
+
+
 def register_blueprints(app):
     '''/api will be for requests for data generated by the app used by the dashboard'''
     from .api import api as api_blueprint
@@ -0,0 +1,62 @@
+import hashlib
+from datetime import timezone
+from flask import request, current_app
+from ..models import db, Shelter, Count
+
+
+def data_version(*count_criteria, extra=()):
+    '''
+    A cheap fingerprint of the data behind a response: the number and latest write time
+    of the counts matching count_criteria and of the shelters, read in a single query.
+    `extra` scalar expressions are read in the same query and added to the version.
+    Returns (version tuple, last modified time or None).
+    '''
+    counts = db.session.query(db.func.count(Count.shelter_id)).filter(*count_criteria).as_scalar()
+    counts_time = db.session.query(db.func.max(Count.written)).filter(*count_criteria).as_scalar()
+    shelters = db.session.query(db.func.count(Shelter.id)).as_scalar()
+    shelters_time = db.session.query(db.func.max(Shelter.updated)).as_scalar()
+
+    version = db.session.query(counts, counts_time, shelters, shelters_time, *extra).one()
+    times = [t for t in (version[1], version[3]) if t is not None]
+    return tuple(version), max(times) if times else None
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def not_modified(etag, last_modified, private=True, max_age=None):
+    '''
+    A 304 response if the request's If-None-Match or If-Modified-Since headers show
+    the client already has this version, otherwise None.
+    private and max_age should match the full response (see add_validators).
+    '''
+    if request.if_none_match:
+        if not request.if_none_match.contains(etag):
+            return None
+    elif request.if_modified_since is None or last_modified is None:
+        return None
+    elif last_modified.astimezone(timezone.utc).replace(tzinfo=None, microsecond=0) > request.if_modified_since:
+        return None
+
+    return add_validators(current_app.response_class(status=304), etag, last_modified, private, max_age)
+
+
+def add_validators(response, etag, last_modified, private=True, max_age=None):
+    '''
+    Set ETag/Last-Modified. Clients must revalidate before reusing the response
+    unless max_age (seconds) says how long it can be reused as is.
+    '''
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if max_age is None:
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.max_age = max_age
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.vary.add('Authorization')
+    return response
@@ -1,8 +1,7 @@
 from functools import wraps
 import flask_jwt_simple as jwt
 from flask import g
-from sqlalchemy.orm import joinedload
-from ..models import User
+from ..auth import load_user
 from app.exceptions import UnauthorizedUse
 
 
@@ -24,8 +23,8 @@ def role_required(allowed_roles):
         def decorated_function(*args, **kwargs):
             user = jwt.get_jwt_identity()
 
-            db_user = User.query.options(joinedload('roles')).filter_by(username=user).first()
-            if db_user is None:
+            db_user = load_user(user)
+            if db_user is None or not db_user.active:
                 raise UnauthorizedUse('Permission denied', 403)
             # make user object available to routes on flask.g
             g.user = db_user
@@ -44,9 +43,10 @@ def add_user():
         def decorated_function(*args, **kwargs):
             user = jwt.get_jwt_identity()
             if user:
-                db_user = User.query.options(joinedload('roles')).filter_by(username=user).first()
+                db_user = load_user(user)
                 # make user object available to routes on flask.g
-                g.user = db_user
+                if db_user is not None and db_user.active:
+                    g.user = db_user
             return f(*args, **kwargs)
         return decorated_function
     return decorator
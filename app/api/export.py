@@ -0,0 +1,202 @@
+import csv
+import json
+import zlib
+from datetime import timedelta
+from io import StringIO
+from itertools import islice
+from flask import Response, current_app, request, stream_with_context
+import pyarrow
+import pyarrow.parquet
+from sqlalchemy import Date, DateTime, Float, Integer
+from app.exceptions import InvalidUsage
+from ..models import db, Shelter, Count
+
+# rows fetched from the server-side cursor at a time
+BATCH_SIZE = 1000
+
+EXPORT_FIELDS = ['day', 'name', 'personcount', 'bedcount', 'shelter_id']
+
+
+def export_query():
+    '''Every count with its shelter's name, in primary key order so no sort is needed'''
+    return db.session.query(
+        Count.shelter_id,
+        Count.bedcount,
+        Count.personcount,
+        Count.day,
+        Shelter.name)\
+        .join(Shelter, Shelter.id == Count.shelter_id)\
+        .order_by(Count.day, Count.shelter_id)
+
+
+def up_to_mark(query):
+    '''
+    Limit a counts query to the counts written up to the latest write time it currently
+    matches, leaving out counts written in the last EXPORT_MARK_LAG seconds. Reading the
+    mark first means a count written while the rows are streamed is left for the next
+    export instead of being skipped by it. Count.written is when the writing transaction
+    started, so a count can commit after an export has read a mark later than it; the
+    lag leaves such counts to the next export, as long as no write takes longer than it.
+    Returns (query, mark), where mark is None if nothing matched.
+    '''
+    lag = timedelta(seconds=current_app.config['EXPORT_MARK_LAG'])
+    query = query.filter(Count.written <= db.func.now() - lag)
+    mark = query.with_entities(db.func.max(Count.written)).order_by(None).scalar()
+    if mark is not None:
+        query = query.filter(Count.written <= mark)
+    return query, mark
+
+
+def stream_rows(query, batch_size=BATCH_SIZE):
+    '''
+    Iterate over a query's rows through a named (server-side) cursor, so only
+    `batch_size` rows are held in memory however large the result is.
+    '''
+    return query.execution_options(stream_results=True).yield_per(batch_size)
+
+
+def batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def csv_lines(rows, fields, batch_size=BATCH_SIZE):
+    '''
+    Yield the CSV header right away, then the rows encoded in chunks of `batch_size`
+    so the response isn't split into a write per row.
+    '''
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    def flush():
+        chunk = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return chunk.encode('utf-8')
+
+    writer.writerow(fields)
+    yield flush()
+    for batch in batches(rows, batch_size):
+        writer.writerows([getattr(row, field) for field in fields] for row in batch)
+        yield flush()
+
+
+def gzip_csv_lines(rows, fields, batch_size=BATCH_SIZE):
+    '''CSV compressed as a single gzip member, flushed after every batch'''
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in csv_lines(rows, fields, batch_size):
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def ndjson_lines(rows, fields, batch_size=BATCH_SIZE):
+    '''One JSON object per line; dates are written in ISO format'''
+    for batch in batches(rows, batch_size):
+        yield ''.join(
+            json.dumps({field: getattr(row, field) for field in fields}, default=lambda d: d.isoformat()) + '\n'
+            for row in batch
+        ).encode('utf-8')
+
+
+class _ChunkSink:
+    '''A write-only file that holds what the Parquet writer writes until it is taken'''
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_type(column_type):
+    if isinstance(column_type, Date):
+        return pyarrow.date32()
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp('us', tz='UTC')
+    if isinstance(column_type, Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, Float):
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def parquet_chunks(rows, fields, batch_size=BATCH_SIZE, types=None):
+    '''
+    Write each batch as a Parquet row group and yield its bytes as soon as it is written.
+    `types` maps field names to SQLAlchemy column types (default: string).
+    '''
+    types = types or {}
+    schema = pyarrow.schema([(field, parquet_type(types.get(field))) for field in fields])
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for batch in batches(rows, batch_size):
+        columns = [[getattr(row, field) for row in batch] for field in fields]
+        writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+# format: (mimetype, file extension, encoder)
+FORMATS = {
+    'csv': ('text/csv', 'csv', csv_lines),
+    'csv.gz': ('application/gzip', 'csv.gz', gzip_csv_lines),
+    'ndjson': ('application/x-ndjson', 'ndjson', ndjson_lines),
+    'parquet': ('application/vnd.apache.parquet', 'parquet', parquet_chunks)
+}
+
+
+def export_format():
+    '''
+    The format asked for with ?format= or, failing that, the Accept header.
+    CSV is the default.
+    '''
+    name = request.args.get('format')
+    if name is None:
+        mimetype = request.accept_mimetypes.best_match([FORMATS[a][0] for a in FORMATS], 'text/csv')
+        name = next(a for a in FORMATS if FORMATS[a][0] == mimetype)
+    if name not in FORMATS:
+        raise InvalidUsage(f"Unknown format {name}", status_code=400)
+    return name
+
+
+def send_export(query, basename, fields, headers=None):
+    '''
+    A response that encodes the query's rows in the requested format while they
+    are read from the database. The request context (and with it the DB session)
+    stays open until the last row is sent.
+    '''
+    mimetype, extension, encoder = FORMATS[export_format()]
+    if encoder is parquet_chunks:
+        types = {c['name']: c['type'] for c in query.column_descriptions}
+        chunks = parquet_chunks(stream_rows(query), fields, types=types)
+    else:
+        chunks = encoder(stream_rows(query), fields)
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={basename}.{extension}', **(headers or {})})
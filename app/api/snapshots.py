@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import tempfile
+from datetime import timezone
+import pendulum
+from sqlalchemy import text
+from ..models import db, Shelter, Count
+from .export import EXPORT_FIELDS, export_query, up_to_mark, stream_rows, csv_lines
+
+MANIFEST = 'manifest.json'
+
+# the export of every count and the export for public shelters
+VARIANTS = {
+    'all': lambda query: query,
+    'public': lambda query: query.filter(Shelter.public)
+}
+
+# advisory lock key held while snapshots are written (refresh_daily_totals uses 1)
+SNAPSHOT_LOCK = 2
+
+
+def variant_dir(root, variant):
+    return os.path.join(root, variant)
+
+
+def read_manifest(root, variant):
+    '''The variant's manifest, or None if no snapshot has been written yet'''
+    try:
+        with open(os.path.join(variant_dir(root, variant), MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_atomic(path, chunks, directory=None):
+    '''
+    Write to a temporary file and move it into place, so readers never see a partial file.
+    `path` may instead be a function called once the chunks are written, for names that
+    depend on the content; the file is then written in `directory`.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=directory or os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, path() if callable(path) else path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_segment(root, variant, kind, query, since=None):
+    '''
+    Write the counts in `query` written after `since` (and up to the current mark)
+    to a new CSV segment. Returns the segment's manifest entry, or None if there were no counts.
+    Segments are served with a long max-age, so the file name includes a hash of the
+    content: a full build at the same mark whose rows differ (a shelter was renamed or
+    made private, a count deleted) gets a new name.
+    '''
+    if since is not None:
+        query = query.filter(Count.written > since)
+    query, mark = up_to_mark(query)
+    if mark is None and kind == 'delta':
+        return None
+
+    stamp = mark.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ') if mark else 'empty'
+    digest = hashlib.sha256()
+    rows = 0
+
+    def counted(rows_iter):
+        nonlocal rows
+        for row in rows_iter:
+            rows += 1
+            yield row
+
+    def hashed(chunks):
+        for chunk in chunks:
+            digest.update(chunk)
+            yield chunk
+
+    def named():
+        nonlocal name
+        name = f"{kind}-{stamp}-{digest.hexdigest()[:12]}.csv"
+        return os.path.join(variant_dir(root, variant), name)
+
+    name = None
+    write_atomic(named, hashed(csv_lines(counted(stream_rows(query)), EXPORT_FIELDS)), variant_dir(root, variant))
+    path = os.path.join(variant_dir(root, variant), name)
+    return {
+        'file': name,
+        'mark': mark.isoformat() if mark else None,
+        'rows': rows,
+        'bytes': os.path.getsize(path)
+    }
+
+
+def build_snapshot(root, variant, full=False):
+    '''
+    Bring one variant's snapshot up to date. A full build writes a new base segment with
+    every count and drops the old segments; otherwise the counts written since the last
+    segment are appended as a delta segment. Later segments supersede earlier rows for
+    the same day and shelter. Deleted counts and changes to shelters (names, public)
+    only show up at the next full build. Returns the new manifest.
+    '''
+    os.makedirs(variant_dir(root, variant), exist_ok=True)
+    manifest = read_manifest(root, variant)
+    query = VARIANTS[variant](export_query())
+
+    if full or manifest is None:
+        old = manifest['segments'] if manifest else []
+        manifest = {'variant': variant, 'segments': [write_segment(root, variant, 'base', query)]}
+    else:
+        old = []
+        since = pendulum.parse(manifest['mark']) if manifest['mark'] else None
+        delta = write_segment(root, variant, 'delta', query, since)
+        if delta is None:
+            return manifest
+        manifest['segments'].append(delta)
+
+    manifest['mark'] = next((s['mark'] for s in reversed(manifest['segments']) if s['mark']), None)
+    write_atomic(
+        os.path.join(variant_dir(root, variant), MANIFEST),
+        [json.dumps(manifest, indent=2).encode('utf-8')])
+
+    # a reader may still be fetching a replaced segment listed in a manifest it read
+    # earlier; it gets a 404 and starts again from the new manifest
+    current = {s['file'] for s in manifest['segments']}
+    for segment in old:
+        if segment['file'] not in current:
+            try:
+                os.unlink(os.path.join(variant_dir(root, variant), segment['file']))
+            except FileNotFoundError:
+                pass
+    return manifest
+
+
+def build_snapshots(root, full=False):
+    '''
+    Update every variant. Returns None without doing anything if another build holds
+    the lock, otherwise the manifests by variant.
+    '''
+    locked = db.session.execute(
+        text('SELECT pg_try_advisory_xact_lock(:key, 0)'),
+        {'key': SNAPSHOT_LOCK}).scalar()
+    if not locked:
+        return None
+    try:
+        return {variant: build_snapshot(root, variant, full) for variant in VARIANTS}
+    finally:
+        # ends the transaction, releasing the lock
+        db.session.commit()
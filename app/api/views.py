@@ -1,20 +1,27 @@
 import os
-from flask_csv import send_csv
 import logging
 import pendulum
 from pendulum.exceptions import ParserError
 from sqlalchemy import Date
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql.expression import cast, true
-from sqlalchemy.sql import func, column
+from sqlalchemy.sql.expression import cast, false, tuple_
+from sqlalchemy.sql import func
 from . import api
 
-from flask import request, jsonify, g
+from flask import request, jsonify, g, current_app, send_from_directory
 from flask_jwt_simple import jwt_required, create_jwt, jwt_optional
 from .forms import newShelterForm
-from ..models import db, Shelter, Count, Log, User
+from ..models import db, Shelter, Count, Log, LogCounter, User, DailyTotal, save_count
 from ..prefs import Prefs
+from ..auth import audience, user_cache
+from ..cache import board_cache, history_cache, counts_changed
 from .decorators import role_required, add_user
+from .conditional import data_version, make_etag, not_modified, add_validators
+from .export import EXPORT_FIELDS, export_query, up_to_mark, send_export
+from .snapshots import build_snapshots, read_manifest, variant_dir
+from ..twilio_api.studio import metrics as studio_metrics
+from ..twilio_api.logsink import LogSink
+from ..twilio_api.spool import Spool
 from app.exceptions import InvalidUsage, UnauthorizedUse, ServerError
 
 # TODO write a real solution for this
@@ -57,7 +64,7 @@ def login():
     if not db_user or db_user.password != password:
         raise UnauthorizedUse()
     roles = [role.name for role in db_user.roles]
-    return jsonify(jwt=create_jwt(identity=user), roles=roles), 200
+    return jsonify(jwt=create_jwt(identity=db_user), roles=roles), 200
 
 ##################
 #    SHELTERS    #
@@ -67,13 +74,30 @@ def login():
 @role_required(['admin'])
 def get_shelters():
     '''
-    All the current shelters
+    All the current shelters with their call statistics
     Response:
         200:
             JSON array containing an object for each shelter
     '''
-    shelters = Shelter.query.order_by('name').all()
-    return jsonify([s.toDict() for s in shelters])
+    # every new log bumps the counters' total
+    calls = db.session.query(func.coalesce(func.sum(LogCounter.total), 0)).as_scalar()
+    version, last_modified = data_version(false(), extra=(calls,))
+    etag = make_etag('shelters', version)
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
+
+    shelters = db.session.query(Shelter, LogCounter)\
+        .outerjoin(LogCounter, LogCounter.shelter_id == Shelter.id)\
+        .order_by(Shelter.name)
+    return add_validators(jsonify([
+        dict(shelter.toDict(), calls=counter.toDict() if counter else empty_counters())
+        for shelter, counter in shelters
+    ]), etag, last_modified)
+
+
+def empty_counters():
+    return {'total': 0, 'errors': 0, 'save_count': 0, 'validate_shelter': 0}
 
 
 @api.route('/delete_shelter/<shelter_id>', methods=['GET'])
@@ -86,6 +110,7 @@ def delete_shelter(shelter_id):
         204:
     '''
     Shelter.query.filter_by(id=shelter_id).delete()
+    counts_changed()
     db.session.commit()
     return '', 204
 
@@ -116,6 +141,7 @@ def update_shelter():
 
     try:
         shelter = db.session.merge(shelter)
+        counts_changed()
         db.session.commit()
     except IntegrityError as e:
         logging.warning(e.orig.args)
@@ -142,14 +168,22 @@ def counts(datestring):
                 tomorrow (YYMMDD)
                 counts: list of shelters and this day's counts
     '''
-    tz = Prefs['timezone']
-    now = pendulum.today(tz)
+    schedule = Prefs.schedule
+    now = schedule.today()
 
     try:
-        today = pendulum.parse(datestring, tz=tz)
+        today = pendulum.parse(datestring, tz=schedule.tz)
     except (ParserError, TypeError):
         today = now
 
+    tier = audience(g.get('user'))
+    key = (today.to_date_string(), tier)
+    cached = board_cache.get(key)
+    if cached is not None:
+        body, etag, last_modified = cached
+        return not_modified(etag, last_modified, tier != 'public') or add_validators(
+            current_app.response_class(body, mimetype='application/json'), etag, last_modified, tier != 'public')
+
     # help browsers navigate dates without worring about local timezone
     yesterday = today.subtract(days=1).format('YYYYMMDD')
     if today < now:
@@ -157,6 +191,12 @@ def counts(datestring):
     else:
         tomorrow = None
 
+    version, last_modified = data_version(Count.day == today.to_date_string())
+    etag = make_etag('counts', key, tomorrow, version)
+    unchanged = not_modified(etag, last_modified, tier != 'public')
+    if unchanged:
+        return unchanged
+
     count_calls = db.session.query(
         Count.shelter_id.label("call_shelterID"),
         Count.bedcount,
@@ -167,7 +207,7 @@ def counts(datestring):
         .subquery()
 
     # Only admins and visitors see percentages
-    if 'user' not in g or set(['admin', 'visitor']).isdisjoint(set([role.name for role in g.user.roles])):
+    if tier == 'public':
         shelterQuery = db.session.query(Shelter.name, Shelter.description, Shelter.id, count_calls)
     else:
         shelterQuery = db.session.query(Shelter.name, Shelter.description, Shelter.capacity, Shelter.id, count_calls)
@@ -175,7 +215,7 @@ def counts(datestring):
     counts = shelterQuery\
         .outerjoin(count_calls, (Shelter.id == count_calls.c.call_shelterID))
 
-    if 'user' in g and 'admin' in [role.name for role in g.user.roles]:
+    if tier == 'admin':
         counts = counts.filter(Shelter.visible == True)
     else:
         counts = counts.filter(Shelter.visible == True, Shelter.public)
@@ -189,7 +229,11 @@ def counts(datestring):
         "date": today.format('YYYY-MM-DD'),
         "counts": list(result_dict)
     }
-    return jsonify(ret)
+    response = jsonify(ret)
+    # past days only change when an admin corrects them, which evicts the cached board
+    ttl = current_app.config['COUNTS_HISTORY_TTL'] if today < now else current_app.config['COUNTS_CACHE_TTL']
+    board_cache.set(key, (response.get_data(), etag, last_modified), ttl)
+    return add_validators(response, etag, last_modified, tier != 'public')
 
 
 @api.route('/counthistory/', methods=['GET'], defaults={'page': 0})
@@ -201,39 +245,171 @@ def counthistory(page):
     Count history for all shelters for the past 14 days.
     Used for chart showing counts over time.
     Supports pagination with page in path
+    Along with each shelter's series it returns network-wide totals from daily_totals
     '''
-    tz = Prefs['timezone']
+    schedule = Prefs.schedule
+    now = schedule.today()
 
     pagesize = 14  # days
     daysback = int(page) * pagesize + pagesize - 1
 
-    today = pendulum.today(tz).subtract(days=(int(page) * pagesize))
-    backthen = pendulum.today(tz).subtract(days=daysback)
-
-    date_list = func.generate_series(
-        cast(backthen.to_date_string(), Date),
-        cast(today.to_date_string(), Date),
-        '1 day'
-    ).alias('gen_day')
-
-    time_series = db.session.query(Shelter.name.label('label'), func.array_agg(Count.personcount).label('data'))\
-        .join(date_list, true())\
-        .outerjoin(Count, (Count.day == column('gen_day')) & (Count.shelter_id == Shelter.id))
-
-    if 'user' not in g or set(['admin', 'visitor']).isdisjoint(set([role.name for role in g.user.roles])):
+    today = now.subtract(days=(int(page) * pagesize))
+    backthen = now.subtract(days=daysback)
+
+    tier = audience(g.get('user'))
+    private = tier != 'public'
+    # pages that end before the current service day can only change through set_count,
+    # which purges them from the cache. Clients still revalidate every time: a page number
+    # means a different range after the rollover, and they'd miss corrections.
+    immutable = today < schedule.service_day()
+    max_age = None
+    key = (backthen.to_date_string(), today.to_date_string(), tier)
+
+    cached = history_cache.get(key)
+    if cached is not None:
+        body, etag, last_modified = cached
+        return not_modified(etag, last_modified, private, max_age) or add_validators(
+            current_app.response_class(body, mimetype='application/json'), etag, last_modified, private, max_age)
+
+    version, last_modified = data_version(Count.day.between(backthen.to_date_string(), today.to_date_string()))
+    etag = make_etag('counthistory', key, version)
+    unchanged = not_modified(etag, last_modified, private, max_age)
+    if unchanged:
+        return unchanged
+
+    dates = [d.to_date_string() for d in (today - backthen)]
+    index = {d: i for i, d in enumerate(dates)}
+
+    # counts is keyed by (day, shelter_id) so this is a primary key range scan
+    time_series = db.session.query(Shelter.id, Shelter.name, Count.day, Count.personcount)\
+        .outerjoin(Count, (Count.shelter_id == Shelter.id) & Count.day.between(dates[0], dates[-1]))
+
+    if tier == 'public':
         time_series = time_series.filter(Shelter.visible == True, Shelter.public)
+        scope = 'public'
     else:
         time_series = time_series.filter(Shelter.visible == True)
+        scope = 'visible'
+
+    shelters = {}
+    for shelter_id, name, day, personcount in time_series.order_by(Shelter.name):
+        series = shelters.setdefault(shelter_id, {"id": shelter_id, "label": name, "data": [None] * len(dates)})
+        if day is not None:
+            series['data'][index[day.isoformat()]] = personcount
+
+    totals = {"personcount": [None] * len(dates), "bedcount": [None] * len(dates), "capacity": [None] * len(dates)}
+    daily_totals = DailyTotal.query\
+        .filter(DailyTotal.scope == scope, DailyTotal.day.between(dates[0], dates[-1]), DailyTotal.shelters > 0)
+    for total in daily_totals:
+        i = index[total.day.isoformat()]
+        for k in totals:
+            totals[k][i] = getattr(total, k)
 
-    time_series = time_series\
-        .group_by(Shelter.name)\
-        .order_by(Shelter.name)
+    results = {
+        "dates": dates,
+        "shelters": list(shelters.values()),
+        "totals": totals
+    }
+    response = jsonify(results)
+    if immutable:
+        history_cache.set(key, (response.get_data(), etag, last_modified))
+    return add_validators(response, etag, last_modified, private, max_age)
+
+
+@api.route('/counthistory/range/', methods=['GET'])
+@jwt_optional
+@add_user()
+def counthistory_range():
+    '''
+    Count history for an arbitrary range of days in one response.
+    parameters (query string):
+        from, to: first and last day (default: the 14 days ending today)
+        shelter: optional shelter id to limit the series to one shelter
+    When the range has more days than HISTORY_POINT_BUDGET the series are downsampled
+    to weekly or monthly means, reported in `bucket` with the first day of each bucket in `dates`.
+    '''
+    schedule = Prefs.schedule
+    try:
+        end = pendulum.parse(request.args['to'], tz=schedule.tz) if request.args.get('to') else schedule.today()
+        start = pendulum.parse(request.args['from'], tz=schedule.tz) if request.args.get('from') else end.subtract(days=13)
+        shelter_id = int(request.args['shelter']) if request.args.get('shelter') else None
+    except (ParserError, ValueError):
+        raise InvalidUsage("Can't parse parameters", status_code=400)
+    start, end = start.start_of('day'), end.start_of('day')
+    if start > end:
+        raise InvalidUsage("from must not be after to", status_code=400)
+
+    budget = current_app.config['HISTORY_POINT_BUDGET']
+    for bucket in ('day', 'week', 'month', 'year'):
+        buckets = [d.to_date_string() for d in pendulum.period(start.start_of(bucket), end).range(f'{bucket}s')]
+        if len(buckets) <= budget:
+            break
+    index = {d: i for i, d in enumerate(buckets)}
+
+    tier = audience(g.get('user'))
+    private = tier != 'public'
+    immutable = end < schedule.service_day()
+    max_age = current_app.config['COUNTHISTORY_MAX_AGE'] if immutable else None
+    # same shape as counthistory keys so corrections purge ranges containing the day
+    key = (start.to_date_string(), end.to_date_string(), tier, shelter_id, bucket)
+
+    cached = history_cache.get(key)
+    if cached is not None:
+        body, etag, last_modified = cached
+        return not_modified(etag, last_modified, private, max_age) or add_validators(
+            current_app.response_class(body, mimetype='application/json'), etag, last_modified, private, max_age)
+
+    version, last_modified = data_version(Count.day.between(key[0], key[1]))
+    etag = make_etag('counthistory_range', key, version)
+    unchanged = not_modified(etag, last_modified, private, max_age)
+    if unchanged:
+        return unchanged
+
+    shelters = Shelter.query.filter(Shelter.visible == True)
+    if tier == 'public':
+        shelters = shelters.filter(Shelter.public)
+        scope = 'public'
+    else:
+        scope = 'visible'
+    if shelter_id is not None:
+        shelters = shelters.filter(Shelter.id == shelter_id)
+    shelters = {s.id: {"id": s.id, "label": s.name, "data": [None] * len(buckets)} for s in shelters.order_by(Shelter.name)}
+
+    if shelters:
+        bucket_day = cast(func.date_trunc(bucket, Count.day), Date)
+        series = db.session.query(Count.shelter_id, bucket_day, func.avg(Count.personcount))\
+            .filter(Count.day.between(key[0], key[1]), Count.shelter_id.in_(list(shelters)))\
+            .group_by(Count.shelter_id, bucket_day)
+        for shelter, day, personcount in series:
+            if personcount is not None:
+                shelters[shelter]['data'][index[day.isoformat()]] = round(float(personcount), 1)
+
+    totals = {"personcount": [None] * len(buckets), "bedcount": [None] * len(buckets), "capacity": [None] * len(buckets)}
+    if shelter_id is None:
+        bucket_day = cast(func.date_trunc(bucket, DailyTotal.day), Date)
+        daily_totals = db.session.query(
+            bucket_day,
+            func.avg(DailyTotal.personcount),
+            func.avg(DailyTotal.bedcount),
+            func.avg(DailyTotal.capacity))\
+            .filter(DailyTotal.scope == scope, DailyTotal.day.between(key[0], key[1]), DailyTotal.shelters > 0)\
+            .group_by(bucket_day)
+        for day, *values in daily_totals:
+            for k, v in zip(("personcount", "bedcount", "capacity"), values):
+                totals[k][index[day.isoformat()]] = round(float(v), 1)
 
     results = {
-        "dates": [d.to_date_string() for d in (today - backthen)],
-        "shelters": [row._asdict() for row in time_series]
+        "from": key[0],
+        "to": key[1],
+        "bucket": bucket,
+        "dates": buckets,
+        "shelters": list(shelters.values()),
+        "totals": totals
     }
-    return jsonify(results)
+    response = jsonify(results)
+    if immutable:
+        history_cache.set(key, (response.get_data(), etag, last_modified))
+    return add_validators(response, etag, last_modified, private, max_age)
 
 
 @api.route('/logs/<shelterid>/', methods=['GET'])
@@ -243,19 +419,59 @@ def counthistory(page):
 def logs(shelterid, page=0):
     '''
     Provives a list of logs for a particular shelter
+    Pages can be requested by number in the path or, in constant time, with the
+    cursor `?before=<time>,<id>` returned as `next` by the previous page
     '''
     pagesize = 15  # records
-    offset = pagesize * int(page)
     shelter = Shelter.query.get_or_404(shelterid)
-    total_calls = db.session.query(func.count(Log.id)).filter_by(shelter_id=shelterid).scalar()
+    counter = LogCounter.query.get(shelterid)
+    calls = counter.toDict() if counter else empty_counters()
     logs = db.session.query(Log)\
         .filter_by(shelter_id=shelterid)\
-        .order_by(Log.time.desc())\
-        .limit(pagesize).offset(offset)
+        .order_by(Log.time.desc(), Log.id.desc())
+
+    before = request.args.get('before')
+    if before:
+        try:
+            time, id = before.rsplit(',', 1)
+            # an unescaped + in the UTC offset arrives as a space
+            cursor = (pendulum.parse(time.replace(' ', '+')), int(id))
+        except (ParserError, ValueError):
+            raise InvalidUsage("Can't parse cursor", status_code=400)
+        logs = logs.filter(tuple_(Log.time, Log.id) < tuple_(*cursor))
+    else:
+        logs = logs.offset(pagesize * int(page))
+
+    result = [row.toDict() for row in logs.limit(pagesize)]
+    next_cursor = f"{result[-1]['time'].isoformat()},{result[-1]['id']}" if len(result) == pagesize else None
 
-    result = [row.toDict() for row in logs]
+    return jsonify(
+        shelter=shelter.name,
+        logs=result,
+        total_calls=calls['total'],
+        calls=calls,
+        page_size=pagesize,
+        next=next_cursor)
 
-    return jsonify(shelter=shelter.name, logs=result, total_calls=total_calls, page_size=pagesize)
+
+@api.route('/metrics/', methods=['GET'])
+@jwt_required
+@role_required(['admin'])
+def metrics():
+    '''
+    This instance's counters for outbound Twilio requests, the webhook log sink and spool, and its caches.
+    Every instance keeps its own, so successive requests may show different numbers.
+    '''
+    return jsonify({
+        "twilio": studio_metrics.stats(),
+        "log_sink": LogSink.stats(),
+        "spool": Spool.stats(),
+        "caches": {
+            "counts": board_cache.stats(),
+            "counthistory": history_cache.stats(),
+            "users": user_cache.stats()
+        }
+    })
 
 
 @api.route('/setcount/', methods=['POST'])
@@ -281,38 +497,28 @@ def set_count():
     except ValueError:
         raise InvalidUsage("Can't parse date", status_code=400)
 
-    if not personcount:
-        count = Count().query.filter_by(shelter_id=shelterID, day=parsed_day.isoformat()).delete()
-        log = Log(
-            shelter_id=shelterID,
-            from_number='web',
-            contact_type="Admin",
-            input_text="-",
-            action="delete_count",
-            parsed_text="")
-        ret = {"personcount": None, "bedcount": None, "shelterID": shelterID}
-    else:
-        shelter = Shelter.query.get(int(shelterID))
-        count = Count(
-            shelter_id=shelterID,
-            personcount=personcount,
-            bedcount=shelter.capacity - int(personcount),
-            day=parsed_day.isoformat(),
-            time=func.now()
-        )
-        log = Log(
-            shelter_id=shelterID,
-            from_number="web",
-            contact_type="Admin",
-            input_text=personcount,
-            action="save_count",
-            parsed_text=personcount
-        )
-        ret = {"personcount": count.personcount, "bedcount": count.bedcount, "shelterID": shelterID}
-        db.session.merge(count)
-
     try:
-        db.session.add(log)
+        if not personcount:
+            Count.query.filter_by(shelter_id=shelterID, day=parsed_day.isoformat()).delete()
+            db.session.add(Log(
+                shelter_id=shelterID,
+                from_number='web',
+                contact_type="Admin",
+                input_text="-",
+                action="delete_count",
+                parsed_text=""))
+            ret = {"personcount": None, "bedcount": None, "shelterID": shelterID}
+        else:
+            saved, bedcount = save_count(shelterID, personcount, parsed_day, {
+                "shelter_id": shelterID,
+                "from_number": "web",
+                "contact_type": "Admin",
+                "input_text": personcount,
+                "action": "save_count",
+                "parsed_text": personcount
+            })
+            ret = {"personcount": saved, "bedcount": bedcount, "shelterID": shelterID}
+        counts_changed(parsed_day)
         db.session.commit()
     except IntegrityError as e:             # calls has a foreign key constraint linking it to shelters
         logging.error(e.orig.args)
@@ -321,62 +527,152 @@ def set_count():
 
     return jsonify({"success": True, "counts": ret})
 
+
+def parse_arg(name, parse):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return parse(value)
+    except (ParserError, ValueError):
+        raise InvalidUsage(f"Can't parse {name}", status_code=400)
+
+
+def export_counts(query):
+    '''
+    Stream the counts in `query` as CSV, gzipped CSV, NDJSON or Parquet
+    (see export.export_format) narrowed by the request's filters:
+        since: only counts written after this time
+        from_day, to_day: only counts for days in this range (inclusive)
+        shelter_id: only counts for this shelter
+    The X-High-Water-Mark header holds the latest write time among the exported
+    counts; passing it back as `since` fetches only what has been written since.
+    Counts written in the last EXPORT_MARK_LAG seconds are left for the next export.
+    Deleted counts are not reported.
+    '''
+    # an unescaped + in the UTC offset arrives as a space
+    since = parse_arg('since', lambda v: pendulum.parse(v.replace(' ', '+')))
+    from_day = parse_arg('from_day', lambda v: pendulum.parse(v).date())
+    to_day = parse_arg('to_day', lambda v: pendulum.parse(v).date())
+    shelter_id = parse_arg('shelter_id', int)
+
+    criteria = []
+    if since is not None:
+        criteria.append(Count.written > since)
+    if from_day is not None:
+        criteria.append(Count.day >= from_day)
+    if to_day is not None:
+        criteria.append(Count.day <= to_day)
+    if shelter_id is not None:
+        criteria.append(Count.shelter_id == shelter_id)
+    query, mark = up_to_mark(query.filter(*criteria))
+    headers = {}
+    if mark is not None:
+        headers['X-High-Water-Mark'] = mark.isoformat()
+    elif since is not None:
+        headers['X-High-Water-Mark'] = since.isoformat()
+
+    return send_export(query, "shelterCounts", EXPORT_FIELDS, headers)
+
+
 # The following two routes are quick stopgaps for allowing api data to be accessed
 # With a token rather than a login
 # TODO: make this more flexible and pull tokens from DB rather than env.
 @api.route(f'/{TEMP_API_KEY}/export/', methods=['GET'])
 def export():
     '''
-    Returns all counts per shelter
+    Returns all counts per shelter, optionally filtered (see export_counts)
     Returns:
         200:
-            JSON object with:
-                counts: list of shelters and this day's counts
+            The counts streamed as they are read, one row per shelter and day
     '''
-
-    # only show person count to admin
-    counts = db.session.query(Count)\
-        .join(Shelter, Shelter.id == Count.shelter_id)\
-        .order_by(Count.day)\
-        .values(
-            Count.shelter_id,
-            Count.bedcount,
-            Count.personcount,
-            Count.day,
-            Shelter.name
-    )
-
-    result_dict = map(lambda q: q._asdict(), counts)
-
-    return send_csv(result_dict, "shelterCounts.csv", ['day', 'name', 'personcount', 'bedcount', 'shelter_id'])
+    return export_counts(export_query())
 
 
 @api.route(f'/{TEMP_PUBLIC_EXPORT_KEY}/export/', methods=['GET'])
 def export_public():
     '''
-    Returns all counts per shelter for public shelters
+    Returns all counts per shelter for public shelters, optionally filtered (see export_counts)
     Returns:
         200:
-            JSON object with:
-                counts: list of shelters and this day's counts
+            The counts streamed as they are read, one row per shelter and day
     '''
+    return export_counts(export_query().filter(Shelter.public))
 
-    # only show person count to admin
-    counts = db.session.query(Count)\
-        .join(Shelter, Shelter.id == Count.shelter_id)\
-        .order_by(Count.day)\
-        .filter(Shelter.public)\
-        .values(
-            Count.shelter_id,
-            Count.bedcount,
-            Count.personcount,
-            Count.day,
-            Shelter.name
-    )
 
-    result_dict = map(lambda q: q._asdict(), counts)
+@api.route('/snapshots/build/', methods=['GET'])
+def build_export_snapshots():
+    '''
+    Cron calls this end point to bring the export snapshots up to date.
+    With ?full=1 (nightly, after the day cutoff) the snapshots are rewritten from scratch,
+    otherwise counts saved since the last run are appended as delta segments.
+    '''
+    # App Engine strips this header from outside requests
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        raise UnauthorizedUse()
+    manifests = build_snapshots(snapshot_root(), full=request.args.get('full') == '1')
+    if manifests is None:
+        return jsonify({"success": False, "error": "A snapshot build is already running"}), 409
+    return jsonify({"success": True, "manifests": manifests})
+
+
+def snapshot_root():
+    root = current_app.config.get('EXPORT_SNAPSHOT_DIR')
+    if not root:
+        raise InvalidUsage("Export snapshots are not enabled", status_code=404)
+    return root
+
+
+def snapshot_manifest(variant):
+    manifest = read_manifest(snapshot_root(), variant)
+    if manifest is None:
+        raise InvalidUsage("No snapshot has been written yet", status_code=404)
+    etag = make_etag('snapshot', variant, [segment['file'] for segment in manifest['segments']])
+    unchanged = not_modified(etag, None)
+    if unchanged:
+        return unchanged
+    return add_validators(jsonify(manifest), etag, None)
+
+
+def snapshot_segment(variant, filename):
+    manifest = read_manifest(snapshot_root(), variant)
+    if manifest is None or filename not in [segment['file'] for segment in manifest['segments']]:
+        raise InvalidUsage("No such snapshot segment", status_code=404)
+    return send_from_directory(
+        variant_dir(snapshot_root(), variant),
+        filename,
+        mimetype='text/csv',
+        as_attachment=True,
+        conditional=True,
+        cache_timeout=current_app.config['EXPORT_SEGMENT_MAX_AGE'])
+
+
+@api.route(f'/{TEMP_API_KEY}/export/snapshot/', methods=['GET'])
+def export_snapshot():
+    '''
+    The manifest of the latest export snapshot: its CSV segments in order (a base with
+    every count, then deltas whose rows replace earlier ones for the same day and shelter)
+    and the high-water mark to pass as `since` to the export for anything newer.
+    '''
+    return snapshot_manifest('all')
+
+
+@api.route(f'/{TEMP_API_KEY}/export/snapshot/<filename>', methods=['GET'])
+def export_snapshot_segment(filename):
+    '''A segment listed in the manifest, with Range and conditional request support'''
+    return snapshot_segment('all', filename)
+
+
+@api.route(f'/{TEMP_PUBLIC_EXPORT_KEY}/export/snapshot/', methods=['GET'])
+def export_public_snapshot():
+    '''The manifest of the latest export snapshot of public shelters'''
+    return snapshot_manifest('public')
+
 
-    return send_csv(result_dict, "shelterCounts.csv", ['day', 'name', 'personcount', 'bedcount', 'shelter_id'])
+@api.route(f'/{TEMP_PUBLIC_EXPORT_KEY}/export/snapshot/<filename>', methods=['GET'])
+def export_public_snapshot_segment(filename):
+    '''A segment listed in the public manifest, with Range and conditional request support'''
+    return snapshot_segment('public', filename)
 
 
 @api.errorhandler(InvalidUsage)
@@ -0,0 +1,114 @@
+from collections import namedtuple
+import flask_jwt_simple as jwt
+from flask import current_app
+from flask_jwt_simple.default_callbacks import default_jwt_data_callback
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+from ..cache import TTLCache
+from ..models import User, UserRoles
+from ..notify import Notifier
+from ..prefs import Prefs
+
+AuthRole = namedtuple('AuthRole', ['name'])
+AuthUser = namedtuple('AuthUser', ['id', 'username', 'active', 'roles'])
+
+# username -> AuthUser for requests whose token claims can't be trusted
+user_cache = TTLCache()
+
+
+def init_auth(app):
+    user_cache.configure(app.config.get('AUTH_CACHE_SIZE', 0), app.config.get('AUTH_CACHE_TTL'))
+
+
+def jwt_data(identity):
+    '''
+    JWT payload loader. When the identity is a User, their roles are added as signed
+    claims along with the current auth_version pref, so later requests can be
+    authorized without looking the user up. Bumping auth_version revokes those claims.
+    '''
+    if isinstance(identity, User):
+        data = default_jwt_data_callback(identity.username)
+        data['roles'] = [role.name for role in identity.roles]
+        data['auth_version'] = Prefs['auth_version']
+        return data
+    return default_jwt_data_callback(identity)
+
+
+def revoke_tokens():
+    '''Stop trusting the role claims of every token issued so far'''
+    Prefs['auth_version'] = Prefs['auth_version'] + 1
+
+
+def token_user():
+    '''
+    Returns an AuthUser built from the role claims in the current JWT, or None if the
+    token has no claims or they were issued before the last revocation
+    '''
+    if not current_app.config.get('JWT_TRUST_ROLE_CLAIMS'):
+        return None
+    claims = jwt.get_jwt()
+    if 'roles' not in claims or claims.get('auth_version') != Prefs['auth_version']:
+        return None
+    return AuthUser(None, jwt.get_jwt_identity(), True, tuple(AuthRole(name) for name in claims['roles']))
+
+
+def cached_user(username):
+    '''AuthUser for username from the user cache, reading it from the DB on a miss'''
+    user = user_cache.get(username)
+    if user is None:
+        db_user = User.query.options(joinedload('roles')).filter_by(username=username).first()
+        if db_user is None:
+            return None
+        user = AuthUser(
+            db_user.id,
+            db_user.username,
+            db_user.active,
+            tuple(AuthRole(role.name) for role in db_user.roles))
+        user_cache.set(username, user)
+    return user
+
+
+def load_user(username):
+    '''
+    The user making this request with their roles. Trusts the token's claims when possible,
+    otherwise uses the user cache. Returns None for unknown users.
+    '''
+    user = token_user()
+    if user is None:
+        user = cached_user(username)
+    return user
+
+
+def audience(user):
+    '''Which view of the shelter data a user gets: admin, visitor or public'''
+    roles = set(role.name for role in user.roles) if user else set()
+    if 'admin' in roles:
+        return 'admin'
+    if 'visitor' in roles:
+        return 'visitor'
+    return 'public'
+
+
+def evict_user(user_id):
+    '''Notifier callback: None means notifications may have been missed'''
+    if user_id is None:
+        user_cache.clear()
+    else:
+        user_cache.evict_where(lambda username, user: str(user.id) == str(user_id))
+
+
+@event.listens_for(Session, 'after_flush')
+def _users_changed(session, flush_context):
+    '''Evict cached users whose rows or roles changed and tell the other instances'''
+    user_ids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, User) and obj.id is not None:
+            user_ids.add(obj.id)
+        elif isinstance(obj, UserRoles) and obj.user_id is not None:
+            user_ids.add(obj.user_id)
+    for user_id in user_ids:
+        evict_user(user_id)
+        Notifier.publish('users', user_id, session)
+
+
+Notifier.subscribe('users', evict_user)
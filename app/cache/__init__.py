@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from ..notify import Notifier
+
+
+class TTLCache:
+    '''
+    A small thread-safe LRU cache whose entries also expire after a time-to-live.
+    Holds at most `maxsize` entries (0 disables caching) and keeps hit/miss counters.
+    '''
+    def __init__(self, maxsize=128, ttl=None):
+        self._lock = threading.Lock()
+        self.configure(maxsize, ttl)
+
+    def configure(self, maxsize, ttl=None):
+        '''Set the size and default ttl (seconds, None for no expiry) and empty the cache'''
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._data = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        '''Store value under key. `ttl` overrides the default ttl for this entry'''
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def evict(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def evict_where(self, predicate):
+        '''Evict every entry for which predicate(key, value) is true'''
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(k, v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+# serialized /api/counts/ responses keyed by (day, audience)
+board_cache = TTLCache()
+# serialized /api/counthistory/ pages that can no longer change, keyed by (first day, last day, audience)
+history_cache = TTLCache()
+
+
+def init_cache(app):
+    board_cache.configure(app.config.get('COUNTS_CACHE_SIZE', 0))
+    history_cache.configure(app.config.get('COUNTHISTORY_CACHE_SIZE', 0))
+
+
+def evict_counts(day):
+    '''
+    Notifier callback for the counts channel: day is an ISO date string,
+    an empty string when every day may have changed (e.g. a shelter was edited)
+    or None when notifications may have been missed
+    '''
+    if not day:
+        board_cache.clear()
+        history_cache.clear()
+    else:
+        board_cache.evict_where(lambda key, value: key[0] == day)
+        history_cache.evict_where(lambda key, value: key[0] <= day <= key[1])
+
+
+def counts_changed(day=None, session=None):
+    '''
+    Call before committing a write to counts (for `day`) or to shelters (no day).
+    Evicts cached boards here and, once the transaction commits, on the other instances.
+    '''
+    if isinstance(day, datetime):
+        day = day.date()
+    day = day.isoformat() if day else ''
+    evict_counts(day)
+    Notifier.publish('counts', day, session)
+
+
+Notifier.subscribe('counts', evict_counts)
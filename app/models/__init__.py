@@ -1,5 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import inspect
+from datetime import datetime
+from sqlalchemy import inspect, event, DDL, Date, literal, select, true
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.sql import func
 
 db = SQLAlchemy()
@@ -20,6 +22,11 @@ class Shelter(db.Model):
     active = db.Column(db.Boolean, server_default="TRUE", nullable=False)
     visible = db.Column(db.Boolean, server_default="TRUE")
     public = db.Column(db.Boolean, server_default="TRUE")
+    updated = db.Column(
+        db.DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+        nullable=False)
 
     def toDict(self):
         return {
@@ -40,11 +47,19 @@ class Count(db.Model):
         db.ForeignKey('shelters.id', ondelete='CASCADE'),
         primary_key=True)
 
+    # when the count was reported
     time = db.Column(
         db.DateTime(timezone=True),
         server_default=func.now(),
         nullable=False,
         server_onupdate=db.func.now())
+    # when the row was last written, which is later than `time` for a count replayed from
+    # the spool; export marks, snapshots and ETags go by this
+    written = db.Column(
+        db.DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+        server_onupdate=db.func.now())
 
     def toDict(self):
         return {
@@ -52,6 +67,87 @@ class Count(db.Model):
         }
 
 
+# the primary key leads with day; this serves per-shelter lookups, such as the history
+# of one shelter, the daily_totals trigger on shelters and cascading shelter deletes
+db.Index('ix_counts_shelter_id_day', Count.shelter_id, Count.day)
+# incremental exports ask for counts written since a time
+db.Index('ix_counts_written', Count.written)
+
+
+class DailyTotal(db.Model):
+    '''
+    Network-wide totals for each day, kept up to date by triggers on counts and shelters.
+    scope is 'visible' for all visible shelters or 'public' for visible public shelters.
+    '''
+    __tablename__ = 'daily_totals'
+    day = db.Column(db.Date, primary_key=True)
+    scope = db.Column(db.String(16), primary_key=True)
+    shelters = db.Column(db.Integer, nullable=False)
+    personcount = db.Column(db.Integer, nullable=False)
+    bedcount = db.Column(db.Integer, nullable=False)
+    capacity = db.Column(db.Integer, nullable=False)
+
+    def toDict(self):
+        return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
+
+
+# Recomputes daily_totals for one day. The advisory lock serializes concurrent writes to
+# the same day so each recount sees the other's committed rows.
+refresh_daily_totals = DDL('''
+CREATE OR REPLACE FUNCTION refresh_daily_totals(d date) RETURNS void AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(1, d - date '2000-01-01');
+    INSERT INTO daily_totals (day, scope, shelters, personcount, bedcount, capacity)
+    SELECT d, scopes.scope,
+        count(c.shelter_id),
+        coalesce(sum(c.personcount), 0),
+        coalesce(sum(c.bedcount), 0),
+        coalesce(sum(c.bedcount + coalesce(c.personcount, 0)), 0)
+    FROM (VALUES ('visible'), ('public')) AS scopes(scope)
+    LEFT JOIN (counts c JOIN shelters s ON s.id = c.shelter_id)
+        ON c.day = d AND s.visible AND (scopes.scope = 'visible' OR s.public)
+    GROUP BY scopes.scope
+    ON CONFLICT (day, scope) DO UPDATE SET
+        shelters = EXCLUDED.shelters,
+        personcount = EXCLUDED.personcount,
+        bedcount = EXCLUDED.bedcount,
+        capacity = EXCLUDED.capacity;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION counts_refresh_daily_totals() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM refresh_daily_totals(OLD.day);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND (TG_OP = 'INSERT' OR NEW.day <> OLD.day) THEN
+        PERFORM refresh_daily_totals(NEW.day);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION shelters_refresh_daily_totals() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_daily_totals(day) FROM counts WHERE shelter_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER counts_daily_totals
+    AFTER INSERT OR UPDATE OR DELETE ON counts
+    FOR EACH ROW EXECUTE PROCEDURE counts_refresh_daily_totals();
+
+CREATE TRIGGER shelters_daily_totals
+    AFTER UPDATE OF visible, public ON shelters
+    FOR EACH ROW
+    WHEN (OLD.visible IS DISTINCT FROM NEW.visible OR OLD.public IS DISTINCT FROM NEW.public)
+    EXECUTE PROCEDURE shelters_refresh_daily_totals();
+''')
+# counts is created after shelters, so both tables exist by now
+event.listen(Count.__table__, 'after_create', refresh_daily_totals.execute_if(dialect='postgresql'))
+
+
 class Log(db.Model):
     __tablename__ = 'logs'
     id = db.Column(db.Integer, primary_key=True)
@@ -63,6 +159,140 @@ class Log(db.Model):
     contact_type = db.Column(db.String)
     action = db.Column(db.String)
     error = db.Column(db.String)
+    # set by writers that may retry, so a log written twice is only stored once
+    idempotency_key = db.Column(db.String)
+
+    def toDict(self):
+        return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs if c.key != 'idempotency_key'}
+
+
+# serves the per-shelter logs pages newest first
+db.Index('ix_logs_shelter_id_time_id', Log.shelter_id, Log.time.desc(), Log.id.desc())
+db.Index('ix_logs_idempotency_key', Log.idempotency_key, unique=True)
+
+
+class LogCounter(db.Model):
+    '''
+    Per-shelter call statistics. A statement trigger on logs increments these in the same
+    transaction as every insert, however many rows it writes. Logs are never deleted
+    except along with their shelter, which also deletes its counters.
+    '''
+    __tablename__ = 'log_counters'
+    shelter_id = db.Column(
+        db.Integer,
+        db.ForeignKey('shelters.id', ondelete='CASCADE'),
+        primary_key=True)
+    total = db.Column(db.Integer, server_default="0", nullable=False)
+    errors = db.Column(db.Integer, server_default="0", nullable=False)
+    save_count = db.Column(db.Integer, server_default="0", nullable=False)
+    validate_shelter = db.Column(db.Integer, server_default="0", nullable=False)
+
+    def toDict(self):
+        return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs if c.key != 'shelter_id'}
+
+
+count_logs = DDL('''
+CREATE OR REPLACE FUNCTION logs_count_calls() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO log_counters AS lc (shelter_id, total, errors, save_count, validate_shelter)
+    SELECT shelter_id,
+        count(*),
+        count(error),
+        count(*) FILTER (WHERE action = 'save_count'),
+        count(*) FILTER (WHERE action = 'validate_shelter')
+    FROM new_logs
+    WHERE shelter_id IS NOT NULL
+    GROUP BY shelter_id
+    ON CONFLICT (shelter_id) DO UPDATE SET
+        total = lc.total + EXCLUDED.total,
+        errors = lc.errors + EXCLUDED.errors,
+        save_count = lc.save_count + EXCLUDED.save_count,
+        validate_shelter = lc.validate_shelter + EXCLUDED.validate_shelter;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER logs_counters
+    AFTER INSERT ON logs
+    REFERENCING NEW TABLE AS new_logs
+    FOR EACH STATEMENT EXECUTE PROCEDURE logs_count_calls();
+''')
+event.listen(Log.__table__, 'after_create', count_logs.execute_if(dialect='postgresql'))
+
+
+def save_count(shelter_id, personcount, day, log, time=None):
+    '''
+    Insert or replace a shelter's count for `day`, with the bedcount worked out from
+    its capacity, and write `log` (a dict of Log columns) in one statement.
+    `time` is when the count was reported, for counts written after the fact (replayed
+    from the spool). Such a count keeps its original `time` but is marked `written` now,
+    so exports and ETags still pick it up. It doesn't replace a count reported after it,
+    and a log whose idempotency_key is already stored isn't written again, so the same
+    count can be saved twice.
+    Returns the saved (personcount, bedcount), (None, None) if nothing was replaced.
+    An unknown shelter (through the log's foreign key) or one without a capacity
+    raises an IntegrityError.
+    '''
+    if isinstance(day, datetime):
+        day = day.date()
+    counts = Count.__table__
+    shelters = Shelter.__table__
+    personcount = literal(int(personcount))
+    reported = func.now() if time is None else literal(time, counts.c.time.type)
+    upsert = insert(counts).from_select(
+        ['shelter_id', 'personcount', 'bedcount', 'day', 'time', 'written'],
+        select([shelters.c.id, personcount, shelters.c.capacity - personcount, literal(day, Date), reported, func.now()])
+        .where(shelters.c.id == int(shelter_id)))
+    saved = upsert.on_conflict_do_update(
+        index_elements=['day', 'shelter_id'],
+        set_={
+            'personcount': upsert.excluded.personcount,
+            'bedcount': upsert.excluded.bedcount,
+            'time': upsert.excluded.time,
+            'written': upsert.excluded.written
+        },
+        where=None if time is None else counts.c.time < upsert.excluded.time
+    ).returning(counts.c.personcount, counts.c.bedcount).cte('saved')
+    logged = insert(Log.__table__).values(**log)\
+        .on_conflict_do_nothing(index_elements=['idempotency_key'])\
+        .returning(Log.__table__.c.id).cte('logged')
+    # select from both so both inserts are part of the statement, whichever wrote nothing
+    row = db.session.execute(
+        select([saved.c.personcount, saved.c.bedcount])
+        .select_from(logged.outerjoin(saved, true(), full=True))).first()
+    return (row.personcount, row.bedcount) if row else (None, None)
+
+
+class DispatchRun(db.Model):
+    '''The start_call dial-out for one service day, resumed by every cron invocation that day'''
+    __tablename__ = 'dispatch_runs'
+    day = db.Column(db.Date, primary_key=True)
+    started = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+    finished = db.Column(db.DateTime(timezone=True))
+    # the earliest time the next call may be started, so every invocation together
+    # stays within TWILIO_CALLS_PER_SECOND
+    next_slot = db.Column(db.DateTime(timezone=True))
+    attempts = db.relationship('DispatchAttempt', backref='run', passive_deletes=True)
+
+    def toDict(self):
+        return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
+
+
+class DispatchAttempt(db.Model):
+    '''How often and how recently a shelter has been dialed during a run'''
+    __tablename__ = 'dispatch_attempts'
+    day = db.Column(db.Date, db.ForeignKey('dispatch_runs.day', ondelete='CASCADE'), primary_key=True)
+    shelter_id = db.Column(
+        db.Integer,
+        db.ForeignKey('shelters.id', ondelete='CASCADE'),
+        primary_key=True)
+    attempts = db.Column(db.Integer, server_default="0", nullable=False)
+    last_attempt = db.Column(db.DateTime(timezone=True))
+    # error from the last attempt, None if Twilio started the call
+    error = db.Column(db.String)
+    # set while an invocation is dialing the shelter so no other one takes it
+    leased_until = db.Column(db.DateTime(timezone=True))
 
     def toDict(self):
         return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
@@ -77,6 +307,7 @@ class Pref(db.Model):
     open_time = db.Column(db.String)
     close_time = db.Column(db.String)
     start_day = db.Column(db.String)
+    auth_version = db.Column(db.Integer, server_default="0", nullable=False)
 
     def toDict(self):
         return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
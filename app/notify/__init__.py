@@ -0,0 +1,103 @@
+import logging
+import select
+import threading
+from sqlalchemy import text
+from ..models import db
+
+
+class __Notifier:
+    '''
+    Thin wrapper around Postgres LISTEN/NOTIFY used to tell every running instance
+    that some cached data has changed.
+
+    publish() queues a notification on the current session. Postgres only delivers it
+    when that transaction commits, so listeners never see uncommitted changes.
+    A single daemon thread per process holds a dedicated connection, LISTENs on every
+    subscribed channel and calls the callbacks with the notification payload.
+    When the connection is lost the callbacks are called with None once it has been
+    reestablished, since notifications sent in the meantime were missed.
+    '''
+    def __init__(self):
+        self.callbacks = {}
+        self.poll_interval = 1.0
+        self.retry_interval = 5.0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def subscribe(self, channel, callback):
+        self.callbacks.setdefault(channel, []).append(callback)
+
+    def publish(self, channel, payload='', session=None):
+        (session or db.session).execute(
+            text('SELECT pg_notify(:channel, :payload)'),
+            {'channel': channel, 'payload': str(payload)})
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, app):
+        if self.running:
+            return
+        with app.app_context():
+            engine = db.get_engine(app)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(engine,), name='pg-notify', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _dispatch(self, channel, payload):
+        for callback in self.callbacks.get(channel, []):
+            try:
+                callback(payload)
+            except Exception:
+                logging.exception("Notification callback failed for channel %s", channel)
+
+    def _connect(self, engine):
+        # detach so the long-lived listening connection does not hold a slot in the pool
+        fairy = engine.raw_connection()
+        fairy.detach()
+        conn = fairy.connection
+        conn.rollback()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            for channel in self.callbacks:
+                cursor.execute(f'LISTEN "{channel}"')
+        return fairy
+
+    def _run(self, engine):
+        first = True
+        while not self._stop.is_set():
+            try:
+                fairy = self._connect(engine)
+            except Exception as e:
+                logging.warning("Could not connect notification listener: %s", e)
+                self._stop.wait(self.retry_interval)
+                continue
+            if not first:
+                for channel in self.callbacks:
+                    self._dispatch(channel, None)
+            first = False
+            try:
+                self._listen(fairy.connection)
+            except Exception as e:
+                logging.warning("Notification listener lost its connection: %s", e)
+            finally:
+                fairy.close()
+
+    def _listen(self, conn):
+        while not self._stop.is_set():
+            if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notice = conn.notifies.pop(0)
+                self._dispatch(notice.channel, notice.payload)
+
+
+Notifier = __Notifier()
@@ -1,5 +1,8 @@
 import os
+import time
 from ..models import Pref, db
+from ..notify import Notifier
+from .schedule import Schedule
 from flask import Blueprint
 
 pref_api = Blueprint('pref_api', __name__)
@@ -9,6 +12,11 @@ class __Prefs:
     '''
     The __Prefs class wraps the sqlalchemy object allowing a mapping of prefs to columms
     Regular key indexing should fetch and set values: p['timezone'] = "America/Anchorage"
+
+    Values are served from a process-local snapshot of the prefs row. The snapshot is
+    refreshed whenever prefs are written through this object and is reloaded from the
+    DB once it is older than `max_age` seconds (None means it never expires on its own).
+    Writes also NOTIFY the `prefs` channel so other instances drop their snapshot.
     '''
     def init(self, app):
         '''
@@ -17,26 +25,53 @@ class __Prefs:
         using a singleton prefs object.
         '''
         self.defaults = defaults()
+        self.max_age = app.config.get('PREFS_MAX_AGE')
+        self._generation = 0
+        self._schedule = None
+        self.invalidate()
         with app.app_context():
             prefs = Pref.query.get(self.defaults['app_id'])
             if prefs is None:
                 prefs = Pref(**self.defaults)
                 db.session.add(prefs)
                 db.session.commit()
+            self._refresh(prefs)
+
+    def invalidate(self):
+        '''Drop the cached snapshot so the next read goes to the DB'''
+        self._generation += 1
+        self._snapshot = None
+
+    def on_notify(self, app_id):
+        '''Notifier callback: app_id is None when notifications may have been missed'''
+        if app_id is None or app_id == self.defaults['app_id']:
+            self.invalidate()
+
+    def _refresh(self, prefs, generation=None):
+        snapshot = prefs.toDict()
+        # don't keep a row read before an invalidation arrived
+        if generation is None or generation == self._generation:
+            self._snapshot = snapshot
+            self._loaded_at = time.monotonic()
+        return snapshot
+
+    def _current(self):
+        # read into a local: the listener thread may invalidate at any time
+        snapshot, loaded_at = self._snapshot, self._loaded_at
+        if snapshot is None or (self.max_age is not None and time.monotonic() - loaded_at > self.max_age):
+            generation = self._generation
+            snapshot = self._refresh(Pref.query.populate_existing().get(self.defaults['app_id']), generation)
+        return snapshot
 
     def __getitem__(self, name):
         if name not in self.defaults:
             raise KeyError
-        prefs = Pref.query.get(self.defaults['app_id'])
-        return getattr(prefs, name)
+        return self._current()[name]
 
     def __setitem__(self, name, value):
         if name not in self.defaults:
             raise KeyError
-        prefs = Pref.query.get(self.defaults['app_id'])
-        setattr(prefs, name, value)
-        db.session.add(prefs)
-        db.session.commit()
+        self.update({name: value})
 
     def update(self, d):
         prefs = Pref.query.get(self.defaults['app_id'])
@@ -45,11 +80,22 @@ class __Prefs:
                 raise KeyError(k)
             setattr(prefs, k, d[k])
         db.session.add(prefs)
+        Notifier.publish('prefs', prefs.app_id)
         db.session.commit()
+        self._refresh(prefs)
+
+    @property
+    def schedule(self):
+        '''The Schedule for the current prefs, rebuilt only when the prefs snapshot changes'''
+        snapshot = self._current()
+        schedule = self._schedule
+        if schedule is None or schedule.source is not snapshot:
+            schedule = Schedule.from_prefs(snapshot)
+            self._schedule = schedule
+        return schedule
 
     def toDict(self):
-        prefs = Pref.query.get(self.defaults['app_id'])
-        return prefs.toDict()
+        return dict(self._current())
 
 
 def defaults():
@@ -59,10 +105,12 @@ def defaults():
         "enforce_hours": True,
         "open_time": os.environ.get('OPEN'),
         "close_time": os.environ.get('CLOSED'),
-        "start_day": os.environ.get('DAY_CUTOFF')
+        "start_day": os.environ.get('DAY_CUTOFF'),
+        "auth_version": 0
     }
 
 
 Prefs = __Prefs()
+Notifier.subscribe('prefs', Prefs.on_notify)
 
 from . import views  # noqa: [E402,E401]
@@ -0,0 +1,82 @@
+import pendulum
+
+
+def saytime(pendObj):
+    '''Function to convert times into sayable phrases'''
+    hour = pendObj.hour
+    ampm = "P M" if hour >= 12 else "A M"
+    hour = 12 if hour % 12 == 0 else hour % 12
+
+    minute = pendObj.minute
+    if minute == 0:
+        minute = "O'clock"
+    elif minute < 10:
+        minute = f"oh {minute}"
+    return f"{hour} {minute} {ampm}"
+
+
+class Schedule:
+    '''
+    The time-related prefs parsed once into pendulum objects.
+    Prefs.schedule builds one of these and only rebuilds it when the prefs change,
+    so requests don't need to reparse the time strings or resolve the timezone.
+    '''
+    def __init__(self, timezone, open_time, close_time, start_day, enforce_hours=True):
+        self.tz = pendulum.timezone(timezone)
+        self.open = pendulum.parse(open_time, tz=self.tz).time()
+        self.close = pendulum.parse(close_time, tz=self.tz).time()
+        self.cutoff = pendulum.parse(start_day, tz=self.tz).time()
+        self.enforce_hours = enforce_hours
+        self.source = None
+        self._text_hours = f"between {self.open.format('h:mm A')} and {self.close.format('h:mm A')}"
+        self._spoken_hours = f"between {saytime(self.open)} and {saytime(self.close)}"
+
+    @classmethod
+    def from_prefs(cls, prefs):
+        schedule = cls(
+            prefs['timezone'],
+            prefs['open_time'],
+            prefs['close_time'],
+            prefs['start_day'],
+            prefs['enforce_hours'])
+        # lets Prefs tell whether this was built from its current snapshot
+        schedule.source = prefs
+        return schedule
+
+    def now(self):
+        return pendulum.now(self.tz)
+
+    def today(self):
+        return pendulum.today(self.tz)
+
+    def service_day(self, now=None):
+        '''
+        The day a count reported at `now` (default: the current time) belongs to.
+        Calls after the start_day cutoff count toward the next day.
+        '''
+        if now is None:
+            today = self.today()
+            now = self.now()
+        else:
+            now = now.in_timezone(self.tz)
+            today = now.start_of('day')
+        if now.time() > self.cutoff:
+            today = today.add(days=1)
+        return today
+
+    def is_open(self, now=None):
+        '''Whether input should be accepted at `now` (default: the current time)'''
+        if not self.enforce_hours:
+            return True
+        now = self.now() if now is None else now.in_timezone(self.tz)
+        now = now.time()
+        if self.open < self.close:
+            return self.open < now < self.close
+        # time spans midnight
+        return now < self.close or now > self.open
+
+    def text_hours(self):
+        return self._text_hours
+
+    def spoken_hours(self):
+        return self._spoken_hours
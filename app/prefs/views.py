@@ -1,13 +1,12 @@
 from . import pref_api, Prefs
-from sqlalchemy.orm import joinedload
 from flask import request, jsonify
 from flask_jwt_simple import jwt_required, get_jwt_identity
-from ..models import User
+from ..auth import load_user
 
 
 def isAdmin(user):
-    db_user = User.query.options(joinedload('roles')).filter_by(username=user).first()
-    if db_user is None:
+    db_user = load_user(user)
+    if db_user is None or not db_user.active:
         return False
     return any(role.name == 'admin' for role in db_user.roles)
 
@@ -0,0 +1,195 @@
+import time
+from datetime import timedelta
+from sqlalchemy import Date, bindparam, or_, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import cast, func
+from ..models import db, Shelter, Count, Log, DispatchRun, DispatchAttempt
+from .studio import StudioClient, CircuitOpen, send_failed
+
+FROM_NUMBER = '+19073121978'
+
+# advisory lock key held while the day's queue is filled (snapshots use 2)
+DISPATCH_LOCK = 3
+
+
+def uncontacted(day):
+    '''Active shelters with a phone number and no count for `day`'''
+    return db.session.query(Shelter.id, Shelter.phone)\
+        .outerjoin(Count, (Count.shelter_id == Shelter.id) & (Count.day == cast(day, Date)))\
+        .filter((Count.day == None) & (Shelter.active == True) & (Shelter.phone != None) & (Shelter.phone != ''))
+
+
+def due(day, redial_interval, max_attempts, exclude=()):
+    '''
+    The queued shelters that may be dialed now: not leased to another invocation,
+    tried fewer than max_attempts times and not within the last redial_interval seconds,
+    and not in `exclude`. Shelters tried the fewest times come first.
+    '''
+    shelters = uncontacted(day)
+    if exclude:
+        shelters = shelters.filter(~Shelter.id.in_(list(exclude)))
+    return shelters\
+        .join(DispatchAttempt, (DispatchAttempt.shelter_id == Shelter.id) & (DispatchAttempt.day == cast(day, Date)))\
+        .filter(
+            (DispatchAttempt.attempts < max_attempts)
+            & or_(
+                DispatchAttempt.last_attempt == None,
+                DispatchAttempt.last_attempt < func.now() - timedelta(seconds=redial_interval))
+            & or_(DispatchAttempt.leased_until == None, DispatchAttempt.leased_until < func.now()))\
+        .order_by(DispatchAttempt.attempts, Shelter.id)
+
+
+def enqueue(day):
+    '''
+    Start the day's run and queue every uncontacted shelter not queued yet. Only one
+    invocation at a time reads the full list; the others go on with the queue as it is.
+    '''
+    db.session.execute(insert(DispatchRun.__table__).values(day=cast(day, Date)).on_conflict_do_nothing())
+    db.session.commit()
+    locked = db.session.execute(
+        text('SELECT pg_try_advisory_xact_lock(:key, 0)'),
+        {'key': DISPATCH_LOCK}).scalar()
+    if locked:
+        db.session.execute(
+            insert(DispatchAttempt.__table__)
+            .from_select(['day', 'shelter_id'], uncontacted(day).with_entities(cast(day, Date), Shelter.id).statement)
+            .on_conflict_do_nothing())
+    # ends the transaction, releasing the lock
+    db.session.commit()
+
+
+def reserve(day, count, rate):
+    '''
+    Reserve `count` consecutive call slots, 1/rate seconds apart, from the day's run
+    and return the time.monotonic() at which each may be used. Every invocation takes
+    its slots from the same row, so together they keep to `rate` however many run.
+    '''
+    runs = DispatchRun.__table__
+    seconds = db.session.execute(
+        runs.update()
+        .where(runs.c.day == cast(day, Date))
+        .values(next_slot=func.greatest(runs.c.next_slot, func.clock_timestamp()) + timedelta(seconds=count / rate))
+        .returning(func.extract('epoch', runs.c.next_slot - func.clock_timestamp()))).scalar()
+    first = time.monotonic() + float(seconds) - count / rate
+    return [first + i / rate for i in range(count)]
+
+
+def claim(day, config, exclude=()):
+    '''
+    Lease the next batch of due shelters (other than those in `exclude`) to this
+    invocation and reserve a call slot for each (None for every slot without
+    TWILIO_CALLS_PER_SECOND). Rows another invocation is claiming are skipped rather
+    than waited for, so concurrent invocations get disjoint batches. Returns the
+    shelters and their slots.
+    '''
+    shelters = due(day, config['TWILIO_REDIAL_INTERVAL'], config['TWILIO_MAX_ATTEMPTS'], exclude)\
+        .limit(config['DISPATCH_BATCH_SIZE'])\
+        .with_for_update(of=DispatchAttempt.__table__, skip_locked=True)\
+        .all()
+    if shelters:
+        db.session.execute(
+            DispatchAttempt.__table__.update()
+            .where((DispatchAttempt.day == cast(day, Date)) & DispatchAttempt.shelter_id.in_([s.id for s in shelters]))
+            .values(leased_until=func.now() + timedelta(seconds=config['DISPATCH_LEASE'])))
+    rate = config['TWILIO_CALLS_PER_SECOND']
+    slots = reserve(day, len(shelters), rate) if shelters and rate else [None] * len(shelters)
+    # don't sit in an open transaction while Twilio is being called; the lease keeps the batch ours
+    db.session.commit()
+    return shelters, slots
+
+
+def record(day, shelters, executions):
+    '''
+    Write one batch's outcome: a log row for every shelter, and an attempt for every
+    shelter whose request Twilio answered. Requests that weren't sent or weren't
+    answered (see studio.send_failed) don't count as attempts, so the next invocation
+    dials those shelters again. Releases the batch's lease, then commits so a later
+    invocation resumes from here.
+    '''
+    db.session.execute(Log.__table__.insert().values([{
+        "shelter_id": shelter.id,
+        "from_number": FROM_NUMBER,
+        "contact_type": 'outgoing_call',
+        "action": "initialize call",
+        "error": None if execution.error is None else str(execution.error)
+    } for shelter, execution in zip(shelters, executions)]))
+
+    dialed = [{
+        "day": cast(day, Date),
+        "shelter_id": shelter.id,
+        "attempts": 1,
+        "last_attempt": func.now(),
+        "error": None if execution.error is None else str(execution.error)
+    } for shelter, execution in zip(shelters, executions) if not send_failed(execution)]
+    if dialed:
+        stmt = insert(DispatchAttempt.__table__).values(dialed)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['day', 'shelter_id'],
+            set_={
+                "attempts": DispatchAttempt.__table__.c.attempts + 1,
+                "last_attempt": stmt.excluded.last_attempt,
+                "error": stmt.excluded.error,
+                "leased_until": None
+            }))
+    undialed = [{
+        "id": shelter.id,
+        "failure": str(execution.error)
+    } for shelter, execution in zip(shelters, executions) if send_failed(execution)]
+    if undialed:
+        db.session.execute(
+            DispatchAttempt.__table__.update()
+            .where((DispatchAttempt.day == cast(day, Date)) & (DispatchAttempt.shelter_id == bindparam('id')))
+            .values(leased_until=None, error=bindparam('failure')),
+            undialed)
+    db.session.execute(DispatchRun.__table__.update().where(DispatchRun.day == cast(day, Date)).values(updated=func.now()))
+    db.session.commit()
+
+
+def dispatch(day, config):
+    '''
+    Dial the shelters due for `day` in leased batches, recording each batch before
+    claiming the next, until none are due, Twilio keeps failing or the time budget is
+    spent. Several invocations can run at once; each dials its own batches, in the
+    call slots it reserved. Returns a summary of the run so far.
+    '''
+    enqueue(day)
+
+    client = StudioClient.from_config(config)
+    # shelters this invocation couldn't reach Twilio for are left to the next one
+    tried = set()
+    deadline = time.monotonic() + config['DISPATCH_TIME_BUDGET']
+    dialed = failed = 0
+    circuit_open = False
+
+    while True:
+        shelters, slots = claim(day, config, tried)
+        if not shelters:
+            break
+        tried.update(shelter.id for shelter in shelters)
+        executions = client.start_executions([{
+            "To": shelter.phone,
+            "From": FROM_NUMBER,
+            "Parameters": f'{{"id":"{shelter.id}"}}'
+        } for shelter in shelters], slots)
+        record(day, shelters, executions)
+
+        dialed += sum(1 for e in executions if e.error is None)
+        failed += sum(1 for e in executions if e.error is not None and not isinstance(e.error, CircuitOpen))
+        circuit_open = any(isinstance(e.error, CircuitOpen) for e in executions)
+        if circuit_open or time.monotonic() >= deadline:
+            break
+
+    remaining = uncontacted(day).count()
+    if remaining == 0:
+        db.session.execute(
+            DispatchRun.__table__.update()
+            .where((DispatchRun.day == cast(day, Date)) & (DispatchRun.finished == None))
+            .values(finished=func.now()))
+    db.session.commit()
+    return {
+        "success": remaining == 0,
+        "dialed": dialed,
+        "failed": failed,
+        "remaining": remaining,
+        "circuit_open": circuit_open
+    }
@@ -0,0 +1,182 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from ..models import db, Log
+from .spool import Spool, UNAVAILABLE, limit_statement_time
+
+# every column but the id, so queued rows can share one multi-row INSERT
+LOG_COLUMNS = [c.key for c in Log.__table__.columns if c.key != 'id']
+
+
+class __LogSink:
+    '''
+    Writes the Twilio webhooks' audit logs. While running, write() queues the row and a
+    daemon thread inserts the queued rows in multi-row batches of up to batch_size, at
+    least every flush_interval seconds. The queue holds at most max_queue rows; when it
+    stays full for put_timeout seconds the caller writes its row itself, which slows the
+    webhooks down to what the database keeps up with instead of growing without bound.
+    When not running (the default), write() inserts and commits right away, giving up
+    after TWILIO_DB_DEADLINE seconds.
+    Rows still queued are written when the sink is stopped, and at exit. Rows that
+    can't be written because the database is unavailable go to the spool if it is enabled.
+    '''
+    def __init__(self):
+        self.batch_size = 100
+        self.flush_interval = 0.5
+        self.max_queue = 10000
+        self.put_timeout = 0.1
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.queued = 0
+            self.written = 0
+            self.batches = 0
+            self.failed = 0
+            self.spooled = 0
+            self.sync_writes = 0
+            self.max_depth = 0
+            self.last_flush = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, app):
+        if self.running:
+            return
+        self.batch_size = app.config['LOG_SINK_BATCH_SIZE']
+        self.flush_interval = app.config['LOG_SINK_FLUSH_INTERVAL']
+        self.max_queue = app.config['LOG_SINK_MAX_QUEUE']
+        self.put_timeout = app.config['LOG_SINK_PUT_TIMEOUT']
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(app,), name='log-sink', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        '''Write what is still queued and stop the thread'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def write(self, **columns):
+        '''
+        Record a Log row given as column values; `time` defaults to now, not to when it is
+        written. Returns False if it was written synchronously and the insert failed.
+        '''
+        row = {key: columns.get(key) for key in LOG_COLUMNS}
+        row['time'] = columns.get('time') or datetime.now(timezone.utc)
+        # a row that is retried (from the spool) is only stored once
+        row['idempotency_key'] = columns.get('idempotency_key') or uuid.uuid4().hex
+        if self.running:
+            try:
+                self._queue.put(row, timeout=self.put_timeout)
+                with self._lock:
+                    self.queued += 1
+                    self.max_depth = max(self.max_depth, self._queue.qsize())
+                return True
+            except queue.Full:
+                logging.warning("Log sink queue is full, writing the log synchronously")
+        with self._lock:
+            self.sync_writes += 1
+        return self._insert([row], current_app.config.get('TWILIO_DB_DEADLINE')) == 1
+
+    def _insert(self, rows, deadline=None):
+        '''
+        Insert rows in one statement and commit, or spool them if the database is
+        unavailable. If one of them is rejected (its shelter was deleted, say) the others
+        are inserted one at a time so only it is lost. Returns how many were kept.
+        '''
+        written = spooled = 0
+        try:
+            limit_statement_time(deadline)
+            db.session.execute(
+                insert(Log.__table__).values(rows)
+                .on_conflict_do_nothing(index_elements=['idempotency_key']))
+            db.session.commit()
+            written = len(rows)
+        except IntegrityError as e:
+            db.session.rollback()
+            if len(rows) > 1:
+                return sum(self._insert([row], deadline) for row in rows)
+            logging.error(e.orig.args)
+        except UNAVAILABLE as e:
+            db.session.rollback()
+            if Spool.enabled:
+                logging.warning("Database unavailable, spooling %d logs: %s", len(rows), e)
+                Spool.put_logs(rows)
+                spooled = len(rows)
+            else:
+                logging.error("Could not write %d logs: %s", len(rows), e)
+        except Exception:
+            db.session.rollback()
+            logging.exception("Could not write %d logs", len(rows))
+        with self._lock:
+            self.written += written
+            self.spooled += spooled
+            self.failed += len(rows) - written - spooled
+        return written + spooled
+
+    def _take(self):
+        '''Wait for a row, then gather more until the batch is full or flush_interval has passed'''
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                if self._stop.is_set():
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, app):
+        while True:
+            batch = self._take()
+            if not batch:
+                if self._stop.is_set():
+                    return
+                continue
+            started = time.monotonic()
+            with app.app_context():
+                self._insert(batch)
+            with self._lock:
+                self.batches += 1
+                self.last_flush = time.monotonic() - started
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self.running,
+                "depth": self._queue.qsize() if self._queue is not None else 0,
+                "max_depth": self.max_depth,
+                "capacity": self.max_queue,
+                "queued": self.queued,
+                "written": self.written,
+                "failed": self.failed,
+                "spooled": self.spooled,
+                "batches": self.batches,
+                "sync_writes": self.sync_writes,
+                "last_flush_seconds": self.last_flush
+            }
+
+
+LogSink = __LogSink()
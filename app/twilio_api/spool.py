@@ -0,0 +1,216 @@
+import json
+import logging
+import sqlite3
+import threading
+from datetime import date, datetime
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError as PoolTimeout
+from ..models import db, Log, save_count
+from ..cache import counts_changed
+
+# the database is down or too slow (including a statement cancelled by
+# limit_statement_time), as opposed to the write itself being wrong
+UNAVAILABLE = (OperationalError, PoolTimeout)
+
+
+def limit_statement_time(seconds):
+    '''Cancel statements in the current transaction that run longer than `seconds` (None for no limit)'''
+    if seconds:
+        db.session.execute(
+            text("SELECT set_config('statement_timeout', :ms, true)"),
+            {'ms': str(int(seconds * 1000))})
+
+
+def _encode(value):
+    return value.isoformat()
+
+
+def _log_row(row):
+    return dict(row, time=datetime.fromisoformat(row['time']) if row.get('time') else None)
+
+
+class __Spool:
+    '''
+    A SQLite file on the instance's disk that the Twilio webhooks write counts and logs to
+    while Postgres is unreachable or slower than TWILIO_DB_DEADLINE, so Studio still gets
+    an answer. A daemon thread replays the entries into Postgres, oldest first, every
+    replay_interval seconds and deletes them once committed. Replaying an entry twice
+    (the process died between the two) stores it once: logs carry an idempotency key
+    and a count never replaces one reported after it.
+    Entries still spooled when an instance is deleted are lost.
+    '''
+    def __init__(self):
+        self.path = None
+        self.replay_interval = 5.0
+        self.batch_size = 100
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.spooled = 0
+            self.replayed = 0
+            self.dropped = 0
+            self.last_error = None
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        # an entry must be on disk before the webhook reports success
+        conn.execute('PRAGMA synchronous = FULL')
+        return conn
+
+    def start(self, app):
+        if self.running:
+            return
+        self.path = app.config['SPOOL_PATH']
+        self.replay_interval = app.config['SPOOL_REPLAY_INTERVAL']
+        self.batch_size = app.config['SPOOL_BATCH_SIZE']
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            with conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS spool (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        entry TEXT NOT NULL
+                    )''')
+        finally:
+            conn.close()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(app,), name='spool-replay', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+        self.path = None
+
+    def _put(self, entries):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT INTO spool (kind, entry) VALUES (?, ?)',
+                    [(kind, json.dumps(entry, default=_encode)) for kind, entry in entries])
+        finally:
+            conn.close()
+        with self._lock:
+            self.spooled += len(entries)
+
+    def put_count(self, shelter_id, personcount, day, log, time):
+        '''Spool a count (see models.save_count) reported at `time`, with its log'''
+        if isinstance(day, datetime):
+            day = day.date()
+        self._put([('count', {
+            'shelter_id': int(shelter_id),
+            'personcount': int(personcount),
+            'day': day,
+            'time': time,
+            'log': dict(log, time=time)
+        })])
+
+    def put_logs(self, rows):
+        '''Spool Log rows given as column values'''
+        self._put([('log', row) for row in rows])
+
+    def pending(self):
+        if not self.enabled:
+            return 0
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT count(*) FROM spool').fetchone()[0]
+        finally:
+            conn.close()
+
+    def _apply(self, kind, entry):
+        '''Write one entry in the current transaction; returns the day of a count'''
+        if kind == 'count':
+            save_count(
+                entry['shelter_id'],
+                entry['personcount'],
+                date.fromisoformat(entry['day']),
+                _log_row(entry['log']),
+                time=datetime.fromisoformat(entry['time']))
+            return entry['day']
+        db.session.execute(
+            insert(Log.__table__).values(**_log_row(entry))
+            .on_conflict_do_nothing(index_elements=['idempotency_key']))
+
+    def replay(self):
+        '''
+        Move spooled entries into Postgres a batch at a time. An entry Postgres rejects
+        (its shelter was deleted, say) is dropped. Stops when the spool is empty or
+        Postgres is still unavailable. Returns how many entries were replayed.
+        '''
+        replayed = 0
+        conn = self._connect()
+        try:
+            while True:
+                rows = conn.execute('SELECT id, kind, entry FROM spool ORDER BY id LIMIT ?', (self.batch_size,)).fetchall()
+                if not rows:
+                    return replayed
+                days = set()
+                dropped = 0
+                try:
+                    for entry_id, kind, entry in rows:
+                        savepoint = db.session.begin_nested()
+                        try:
+                            days.add(self._apply(kind, json.loads(entry)))
+                            savepoint.commit()
+                        except IntegrityError as e:
+                            savepoint.rollback()
+                            logging.error("Dropping spooled %s %d: %s", kind, entry_id, e.orig.args)
+                            dropped += 1
+                    for day in days - {None}:
+                        counts_changed(date.fromisoformat(day))
+                    db.session.commit()
+                except UNAVAILABLE as e:
+                    db.session.rollback()
+                    with self._lock:
+                        self.last_error = str(e)
+                    return replayed
+                with conn:
+                    conn.execute('DELETE FROM spool WHERE id <= ?', (rows[-1][0],))
+                replayed += len(rows) - dropped
+                with self._lock:
+                    self.replayed += len(rows) - dropped
+                    self.dropped += dropped
+        finally:
+            conn.close()
+
+    def _run(self, app):
+        while not self._stop.wait(self.replay_interval):
+            with app.app_context():
+                try:
+                    self.replay()
+                except Exception:
+                    logging.exception("Could not replay the spool")
+
+    def stats(self):
+        pending = self.pending()
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "pending": pending,
+                "spooled": self.spooled,
+                "replayed": self.replayed,
+                "dropped": self.dropped,
+                "last_error": self.last_error
+            }
+
+
+Spool = __Spool()
@@ -0,0 +1,273 @@
+import base64
+import http.client
+import logging
+import os
+import threading
+import time
+import socket
+import urllib.parse
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# the outcome of one execution request: the HTTP status, or the error that prevented it
+Execution = namedtuple('Execution', ['status', 'error'])
+
+
+def send_failed(execution):
+    '''
+    True if Twilio didn't answer the request: it wasn't sent (the circuit was open),
+    timed out or got a 5xx or 429. A 4xx is about the request itself (e.g. a bad
+    number) and counts as answered.
+    '''
+    return execution.error is not None and not (execution.status and execution.status < 500 and execution.status != 429)
+
+
+class StudioError(Exception):
+    '''Twilio answered an execution request with an error status'''
+    def __init__(self, status, body):
+        Exception.__init__(self, f"Twilio returned {status}: {body[:200]}")
+        self.status = status
+
+
+class CircuitOpen(Exception):
+    '''The request was not sent because too many requests before it failed'''
+    def __init__(self):
+        Exception.__init__(self, "Not dialed: Twilio requests are failing")
+
+
+class CircuitBreaker:
+    '''
+    Opens after `threshold` consecutive failures; while open, allow() is False.
+    A client uses one breaker per run, so the next run (a cron retry) tries again.
+    '''
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        return self.threshold is None or self.failures < self.threshold
+
+    def record(self, failed):
+        with self.lock:
+            self.failures = self.failures + 1 if failed else 0
+            if failed and self.failures == self.threshold:
+                metrics.record_open()
+
+
+class __StudioMetrics:
+    '''
+    Process-wide counters and recent latencies for the requests sent to Twilio Studio,
+    served by /api/metrics/.
+    '''
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.failures = 0
+            self.timeouts = 0
+            self.skipped = 0
+            self.circuit_opened = 0
+            self.latencies = deque(maxlen=self.window)
+
+    def record(self, seconds, failed, timed_out=False):
+        with self.lock:
+            self.requests += 1
+            self.failures += failed
+            self.timeouts += timed_out
+            self.latencies.append(seconds)
+
+    def record_skipped(self):
+        with self.lock:
+            self.skipped += 1
+
+    def record_open(self):
+        with self.lock:
+            self.circuit_opened += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                "requests": self.requests,
+                "failures": self.failures,
+                "timeouts": self.timeouts,
+                "skipped": self.skipped,
+                "circuit_opened": self.circuit_opened
+            }
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+        stats["latency"] = {
+            "window": len(latencies),
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "max": latencies[-1] if latencies else None
+        }
+        return stats
+
+
+metrics = __StudioMetrics()
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket: take() blocks until a token is free. Tokens refill at
+    `rate` per second and at most `capacity` accumulate, which bounds the burst size.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class StudioClient:
+    '''
+    Starts Twilio Studio flow executions. Each start_executions call (one batch) sends
+    its requests from a bounded pool of threads, each reusing its own keep-alive
+    connection to Twilio for the batch; the connections are closed when the batch ends.
+    A token bucket shared by the threads keeps the request rate within calls_per_second
+    (None for no limit). That only limits this client; callers that run several clients
+    at once pass each request's slot (see dispatch.reserve) to start_executions.
+    Connecting and waiting for each response are limited to connect_timeout and
+    read_timeout seconds. After failure_threshold consecutive failures (see send_failed)
+    the batch's remaining routes are skipped.
+    '''
+    def __init__(self, url, username, password, max_workers=4, calls_per_second=None,
+                 connect_timeout=None, read_timeout=None, failure_threshold=None):
+        self.url = url
+        parts = urllib.parse.urlsplit(url)
+        self._https = parts.scheme == 'https'
+        self._netloc = parts.netloc
+        self._path = parts.path
+        credentials = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        self._headers = {
+            'Authorization': 'Basic ' + credentials,
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Connection': 'keep-alive'
+        }
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(calls_per_second) if calls_per_second else None
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.failure_threshold = failure_threshold
+        self.breaker = CircuitBreaker(failure_threshold)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open = []
+
+    @classmethod
+    def from_config(cls, config):
+        '''A client for the flow set in the environment, limited as in the app config'''
+        return cls(
+            os.environ['TWILIO_FLOW_BASE_URL'] + os.environ['TWILIO_FLOW_ID'] + "/Executions",
+            os.environ['TWILIO_USERNAME'],
+            os.environ['TWILIO_PASSWORD'],
+            max_workers=config['TWILIO_MAX_CONCURRENCY'],
+            calls_per_second=config['TWILIO_CALLS_PER_SECOND'],
+            connect_timeout=config['TWILIO_CONNECT_TIMEOUT'],
+            read_timeout=config['TWILIO_READ_TIMEOUT'],
+            failure_threshold=config['TWILIO_FAILURE_THRESHOLD'])
+
+    def _connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            conn = conn_class(self._netloc, timeout=self.connect_timeout)
+            self._local.connection = conn
+            with self._lock:
+                self._open.append(conn)
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    def post(self, data):
+        '''
+        POST form data to the flow on this thread's connection and return the status.
+        Raises StudioError for error statuses.
+        '''
+        conn = self._connection()
+        try:
+            if conn.sock is None:
+                conn.connect()
+                conn.sock.settimeout(self.read_timeout)
+            conn.request('POST', self._path, data, self._headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            # the connection can't be reused once a request on it failed
+            self._close()
+            raise
+        if response.will_close:
+            self._close()
+        if response.status >= 400:
+            raise StudioError(response.status, body.decode('utf-8', 'replace'))
+        return response.status
+
+    def _start(self, data, slot=None):
+        if slot is not None:
+            time.sleep(max(0, slot - time.monotonic()))
+        if not self.breaker.allow():
+            metrics.record_skipped()
+            return Execution(None, CircuitOpen())
+        if self.bucket is not None:
+            self.bucket.take()
+        started = time.monotonic()
+        try:
+            status = self.post(data)
+            logging.info("Twilio Return Code: %d" % status)
+            execution = Execution(status, None)
+        except Exception as e:
+            logging.error("Could not start Twilio flow execution: %s", e)
+            execution = Execution(getattr(e, 'status', None), e)
+        metrics.record(time.monotonic() - started, execution.error is not None, isinstance(execution.error, socket.timeout))
+        self.breaker.record(send_failed(execution))
+        return execution
+
+    def close(self):
+        '''Close every connection the client has opened'''
+        with self._lock:
+            connections, self._open = self._open, []
+        for conn in connections:
+            conn.close()
+
+    def start_executions(self, routes, slots=None):
+        '''
+        Start a flow execution for each route (a dict of To, From and Parameters),
+        each no earlier than its slot in `slots` (time.monotonic() values) if given.
+        Returns an Execution for each route, in the same order; routes skipped
+        because the circuit opened have a CircuitOpen error.
+        '''
+        bodies = [urllib.parse.urlencode(route).encode() for route in routes]
+        if not bodies:
+            return []
+        slots = slots or [None] * len(bodies)
+        self.breaker = CircuitBreaker(self.failure_threshold)
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(bodies))) as pool:
+                return list(pool.map(self._start, bodies, slots))
+        finally:
+            # the pool's threads are gone, so nothing can reuse their connections
+            self.close()
@@ -1,107 +1,32 @@
 from . import twilio_api
-from ..models import Shelter, db, Count, Log
+from ..models import Shelter, db, save_count
 from ..prefs import Prefs
+from ..cache import counts_changed
+from .dispatch import dispatch
+from .logsink import LogSink
+from .spool import Spool, UNAVAILABLE, limit_statement_time
 import logging
-import os
-import pendulum
 import re
-import urllib.request
-import urllib.parse
-from flask import request, jsonify, Response
-from sqlalchemy import Date
+import uuid
+from datetime import datetime, timezone
+from flask import request, jsonify, current_app
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql.expression import cast, func
-
-
-def saytime(pendObj):
-    '''Function to convert times into sayable phrases'''
-    hour = pendObj.hour
-    ampm = "P M" if hour >= 12 else "A M"
-    hour = 12 if hour % 12 == 0 else hour % 12
-
-    minute = pendObj.minute
-    if minute == 0:
-        minute = "O'clock"
-    elif minute < 10:
-        minute = f"oh {minute}"
-    return f"{hour} {minute} {ampm}"
 
 
 def fail(reason, tries):
     return jsonify({"success": False, "error": reason, "tries": tries})
 
 
-def commitLog(log):
-    try:
-        db.session.add(log)
-        db.session.commit()
-    except IntegrityError as e:
-        logging.error(e.orig.args)
-        db.session().rollback()
-
-
-# Set up basic auth with a user/password for Twilio API
-password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-
-password_mgr.add_password(
-    None,
-    os.environ['TWILIO_FLOW_BASE_URL'],
-    os.environ['TWILIO_USERNAME'],
-    os.environ['TWILIO_PASSWORD'])
-
-handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
-opener = urllib.request.build_opener(handler)
-urllib.request.install_opener(opener)
-
-
 @twilio_api.route('/start_call/', methods=['GET'])
 def startcall():
     '''
-    Cron calls this end point to start the flow
-    for each number that hasn't been contacted today
+    Cron calls this end point to start the flow for each number that hasn't been
+    contacted today. Every call resumes the day's run (see dispatch.dispatch): shelters
+    that haven't reported are redialed once TWILIO_REDIAL_INTERVAL has passed, up to
+    TWILIO_MAX_ATTEMPTS times. "success" is true once every shelter has reported.
     '''
-    flowURL = os.environ['TWILIO_FLOW_BASE_URL'] + os.environ['TWILIO_FLOW_ID'] + "/Executions"
-
-    today = pendulum.today(Prefs['timezone'])
-    if pendulum.now(Prefs['timezone']).time() > pendulum.parse(Prefs['start_day'], tz=Prefs['timezone']).time():
-        today = today.add(days=1)
-
-    '''
-    -- get all shelters where there is no count for today. SQL:
-        SELECT * FROM shelters
-        LEFT OUTER JOIN counts ON counts.shelter_id = shelters.id AND counts.day = CAST(%(param_1)s AS DATE)
-        WHERE counts.day IS NULL AND shelters.active = true AND shelters.phone
-        IS NOT NULL AND shelters.phone != %(phone_1)s
-    '''
-    uncontacted = Shelter.query.outerjoin(
-        Count,
-        (Count.shelter_id == Shelter.id) & (Count.day == cast(today, Date)))\
-        .filter((Count.day == None) & (Shelter.active == True) & (Shelter.phone != None) & (Shelter.phone != ''))
-
-    if uncontacted.count() == 0:
-        return jsonify({"success": True})
-
-    for shelter in uncontacted:
-        id = shelter.id
-        route = {"To": shelter.phone,
-                 "From": "+19073121978",
-                 "Parameters": f'{{"id":"{id}"}}'}
-
-        data = urllib.parse.urlencode(route).encode()
-
-        with urllib.request.urlopen(flowURL, data) as f:
-            logging.info("Twilio Return Code: %d" % f.getcode())
-
-        log = Log(
-            shelter_id=id,
-            from_number='+19073121978',
-            contact_type='outgoing_call',
-            action="initialize call")
-
-        db.session.add(log)
-        db.session.commit()
-
-    return Response("Not all shelters contacted", status=449)
+    today = Prefs.schedule.service_day()
+    return jsonify(dispatch(today, current_app.config))
 
 
 @twilio_api.route('/log_failed_call/', methods=['POST'])
@@ -112,13 +37,8 @@ def logFailedCall():
     contact_type = request.form.get('contactType') or 'unknown'
     shelterID = request.form.get('shelterID')
 
-    log = Log(shelter_id=shelterID, from_number=fromPhone, contact_type=contact_type, error=error)
-    try:
-        db.session.add(log)                # TODO it would be nicer if we could use Postgres's ON CONFLICT…UPDATE
-        db.session.commit()
-    except IntegrityError as e:            # calls has a foreign key constraint linking it to shelters
-        logging.error(e.orig.args)
-        db.session().rollback()
+    # calls has a foreign key constraint linking it to shelters
+    if not LogSink.write(shelter_id=shelterID, from_number=fromPhone, contact_type=contact_type, error=error):
         return fail("Could not record call because of database error", 1)
 
     return jsonify({"success": True})
@@ -129,17 +49,10 @@ def validate_time():
     '''The app should only accept input during certain hours. This will return true of
        false depending on whether the current time is within the open hours
     '''
-    start = pendulum.parse(Prefs['open_time'], tz=Prefs['timezone']).time()
-    end = pendulum.parse(Prefs['close_time'], tz=Prefs['timezone']).time()
-    now = pendulum.now(Prefs['timezone']).time()
-    openHours_speech = f"between {saytime(start)} and {saytime(end)}"
-    text_hours = f"between {start.format('h:mm A')} and {end.format('h:mm A')}"
+    schedule = Prefs.schedule
 
-    if Prefs['enforce_hours']:
-        if start < end:
-            return jsonify({"open": start < now < end, "hours": text_hours, "spoken_hours": openHours_speech})
-        else:  # time spans midnight
-            return jsonify({"open": now < end or now > start, "hours": text_hours, "spoken_hours": openHours_speech})
+    if schedule.enforce_hours:
+        return jsonify({"open": schedule.is_open(), "hours": schedule.text_hours(), "spoken_hours": schedule.spoken_hours()})
     else:
         return jsonify({"open": True})
 
@@ -168,14 +81,13 @@ def validateshelter():
     shelter = Shelter.query.filter_by(login_id=shelterID).first()
 
     if shelter:
-        log = Log(
+        LogSink.write(
             shelter_id=shelter.id,
             from_number=fromPhone,
             contact_type=contact_type,
             input_text=input,
             parsed_text=shelterID,
             action="validate_shelter")
-        commitLog(log)
         return jsonify({
             "success": True,
             "id": shelter.id,
@@ -183,14 +95,13 @@ def validateshelter():
             "name": shelter.name
         })
     else:
-        log = Log(
+        LogSink.write(
             from_number=fromPhone,
             contact_type=contact_type,
             input_text=input,
             parsed_text=shelterID,
             error="invalid shelter id",
             action="validate_shelter")
-        commitLog(log)
         return fail("Could not identify shelter", tries + 1)
 
 
@@ -222,52 +133,46 @@ def collect():
         if len(numbers) == 1:
             personcount = numbers[0]
     if personcount and personcount.isdigit() and shelterID:
-        today = pendulum.today(Prefs['timezone'])
-        # set the cutoff where calls count toward the next day
-        if pendulum.now(Prefs['timezone']).time() > pendulum.parse(Prefs['start_day'], tz=Prefs['timezone']).time():
-            today = today.add(days=1)
-
-        shelter = Shelter.query.get(int(shelterID))
-        # TODO handle error if shelter is not found
-        count = Count(
-            shelter_id=shelterID,
-            personcount=personcount,
-            bedcount=shelter.capacity - int(personcount),
-            day=today.isoformat(),
-            time=func.now())
-
-        log = Log(
-            shelter_id=shelterID,
-            from_number=fromPhone,
-            contact_type=contact_type,
-            input_text=input,
-            action="save_count",
-            parsed_text=personcount)
+        # calls after the day cutoff count toward the next day
+        today = Prefs.schedule.service_day()
+
+        log = {
+            "shelter_id": shelterID,
+            "from_number": fromPhone,
+            "contact_type": contact_type,
+            "input_text": input,
+            "action": "save_count",
+            "parsed_text": personcount,
+            "idempotency_key": uuid.uuid4().hex
+        }
 
         try:
-            db.session.merge(count)             # TODO it would be nicer if we could use Postgres's ON CONFLICT…UPDATE
-            db.session.add(log)
+            limit_statement_time(current_app.config['TWILIO_DB_DEADLINE'])
+            save_count(shelterID, personcount, today, log)
+            counts_changed(today)
             db.session.commit()
-        except IntegrityError as e:             # calls has a foreign key constraint linking it to shelters
+        except IntegrityError as e:             # unknown shelter, or one without a capacity
             logging.error(e.orig.args)
             db.session().rollback()
             return fail("Could not record call because of database error", tries + 1)
+        except UNAVAILABLE as e:
+            db.session().rollback()
+            if not Spool.enabled:
+                logging.error(e)
+                return fail("Could not record call because of database error", tries + 1)
+            # the caller shouldn't have to call again; the count is saved once the database is back
+            logging.warning("Database unavailable, spooling the count: %s", e)
+            Spool.put_count(shelterID, personcount, today, log, datetime.now(timezone.utc))
 
         return jsonify({"success": True, "count": personcount})
 
-    log = Log(
+    LogSink.write(
         shelter_id=shelterID,
         from_number=fromPhone,
         contact_type=contact_type,
         input_text=input,
         error="bad input",
-        action="save_count", parsed_text=personcount)
-
-    try:
-        db.session.add(log)
-        db.session.commit()
-    except IntegrityError as e:             # calls has a foreign key constraint linking it to shelters
-        logging.error(e.orig.args)
-        db.session().rollback()
+        action="save_count",
+        parsed_text=personcount)
 
     return fail('Required parameters missing', tries + 1)
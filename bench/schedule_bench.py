@@ -0,0 +1,48 @@
+'''
+Micro-benchmark comparing the per-request parsing the time-dependent endpoints used to do
+with the precompiled Schedule kept by Prefs.
+
+Run from the repo root with the app's environment variables set:
+    python -m bench.schedule_bench
+'''
+import timeit
+import pendulum
+from app.prefs.schedule import Schedule, saytime
+
+prefs = {
+    "timezone": "America/Anchorage",
+    "enforce_hours": True,
+    "open_time": "20:00",
+    "close_time": "03:00",
+    "start_day": "22:00"
+}
+
+
+def parse_per_request():
+    '''What startcall/collect and validate_time each did before Schedule'''
+    today = pendulum.today(prefs['timezone'])
+    if pendulum.now(prefs['timezone']).time() > pendulum.parse(prefs['start_day'], tz=prefs['timezone']).time():
+        today = today.add(days=1)
+    start = pendulum.parse(prefs['open_time'], tz=prefs['timezone']).time()
+    end = pendulum.parse(prefs['close_time'], tz=prefs['timezone']).time()
+    now = pendulum.now(prefs['timezone']).time()
+    spoken = f"between {saytime(start)} and {saytime(end)}"
+    is_open = now < end or now > start
+    return today, is_open, spoken
+
+
+schedule = Schedule.from_prefs(prefs)
+
+
+def precompiled():
+    return schedule.service_day(), schedule.is_open(), schedule.spoken_hours()
+
+
+def main(number=2000):
+    for name, f in (('per-request parsing', parse_per_request), ('Schedule', precompiled)):
+        best = min(timeit.repeat(f, number=number, repeat=5))
+        print(f"{name:>20}: {best / number * 1e6:8.1f} us/request")
+
+
+if __name__ == '__main__':
+    main()
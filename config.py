@@ -8,10 +8,84 @@ class Config:
     SECRET_KEY = os.environ['SECRET_KEY']
     JWT_SECRET_KEY = os.environ['JWT_KEY']
     JWT_EXPIRES = timedelta(days=7)
+    # authorize with the roles signed into the JWT at login instead of looking the user up
+    JWT_TRUST_ROLE_CLAIMS = True
+    # users (and their roles) looked up for authorization are cached for AUTH_CACHE_TTL seconds
+    AUTH_CACHE_SIZE = 256
+    AUTH_CACHE_TTL = 300
+    # /api/counts/ boards are cached per day and audience. Boards for today (or later)
+    # expire after COUNTS_CACHE_TTL seconds, past days after COUNTS_HISTORY_TTL.
+    # Writes to counts and shelters evict them on every instance.
+    COUNTS_CACHE_SIZE = 512
+    COUNTS_CACHE_TTL = 60
+    COUNTS_HISTORY_TTL = 60 * 60 * 24
+    # /api/counthistory/ pages covering only closed days are cached until a count
+    # in their range is corrected. Clients may reuse /api/counthistory/range/ responses
+    # for closed days for COUNTHISTORY_MAX_AGE seconds; numbered pages shift at every
+    # service-day rollover, so clients always revalidate those.
+    COUNTHISTORY_CACHE_SIZE = 256
+    COUNTHISTORY_MAX_AGE = 60 * 60 * 24
+    # /api/counthistory/range/ series longer than this are downsampled to weekly or monthly means
+    HISTORY_POINT_BUDGET = 120
+    # directory that export snapshots are written to and served from (None disables them).
+    # Every instance must see the same directory, e.g. a mounted bucket.
+    EXPORT_SNAPSHOT_DIR = os.environ.get('EXPORT_SNAPSHOT_DIR')
+    # exports and snapshots leave out counts written in the last EXPORT_MARK_LAG seconds, so a
+    # save that commits after an export has read its high-water mark isn't skipped by the next
+    EXPORT_MARK_LAG = 60
+    # snapshot segment names include a hash of their content, so clients may keep them this many seconds
+    EXPORT_SEGMENT_MAX_AGE = 60 * 60 * 24 * 365
+    # start_call sends Twilio Studio requests from up to TWILIO_MAX_CONCURRENCY threads, at most
+    # TWILIO_CALLS_PER_SECOND per second across all concurrent invocations (Twilio's default
+    # outbound calls-per-second limit is 1)
+    TWILIO_MAX_CONCURRENCY = 4
+    TWILIO_CALLS_PER_SECOND = 1
+    # seconds to wait for a connection to Twilio and then for each response
+    TWILIO_CONNECT_TIMEOUT = 5
+    TWILIO_READ_TIMEOUT = 15
+    # stop a start_call run after this many Twilio requests in a row have failed;
+    # the shelters left are dialed by the next cron retry
+    TWILIO_FAILURE_THRESHOLD = 5
+    # shelters that haven't reported are dialed again after TWILIO_REDIAL_INTERVAL seconds,
+    # at most TWILIO_MAX_ATTEMPTS times a day
+    TWILIO_REDIAL_INTERVAL = 30 * 60
+    TWILIO_MAX_ATTEMPTS = 3
+    # a start_call request dials DISPATCH_BATCH_SIZE shelters at a time, recording each batch,
+    # and starts no new batch after DISPATCH_TIME_BUDGET seconds; the next cron call resumes
+    DISPATCH_BATCH_SIZE = 20
+    DISPATCH_TIME_BUDGET = 240
+    # seconds a batch stays leased to the invocation dialing it; an invocation that dies
+    # mid-batch leaves its shelters to others once the lease runs out
+    DISPATCH_LEASE = 300
     SQLALCHEMY_DATABASE_URI = os.environ['SQLALCHEMY_DATABASE_URI']
     SQLALCHEMY_ENGINE_OPTIONS = {
-        "pool_pre_ping": True
+        "pool_pre_ping": True,
+        # fail fast when the database is unreachable instead of waiting on TCP
+        "connect_args": {"connect_timeout": 5}
     }
+    # seconds a cached copy of the prefs row may be served before rereading it
+    # None keeps it until a NOTIFY from another instance says it changed
+    PREFS_MAX_AGE = None
+    # run a LISTEN thread so changes made on other instances invalidate local caches
+    NOTIFY_LISTEN = True
+    # write the Twilio webhooks' logs from a background thread in batches of up to
+    # LOG_SINK_BATCH_SIZE rows, at least every LOG_SINK_FLUSH_INTERVAL seconds. At most
+    # LOG_SINK_MAX_QUEUE rows wait; a webhook that can't queue its row within
+    # LOG_SINK_PUT_TIMEOUT seconds writes it itself. Logs still queued when an instance
+    # is killed without shutting down are lost.
+    LOG_SINK_ENABLED = os.environ.get('LOG_SINK_ENABLED') == '1'
+    LOG_SINK_BATCH_SIZE = 100
+    LOG_SINK_FLUSH_INTERVAL = 0.5
+    LOG_SINK_MAX_QUEUE = 10000
+    LOG_SINK_PUT_TIMEOUT = 0.1
+    # webhook writes give up after TWILIO_DB_DEADLINE seconds. If SPOOL_PATH is set, writes
+    # that can't reach the database in time are kept in that SQLite file and replayed,
+    # SPOOL_BATCH_SIZE entries at a time, every SPOOL_REPLAY_INTERVAL seconds.
+    # The file must be on a disk that outlives the process, though not the instance.
+    TWILIO_DB_DEADLINE = 2
+    SPOOL_PATH = os.environ.get('SPOOL_PATH')
+    SPOOL_REPLAY_INTERVAL = 5
+    SPOOL_BATCH_SIZE = 100
     @staticmethod
     def init_app(app):
         pass
@@ -25,6 +99,12 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'postgresql+psycopg2://localhost/shelter_caller_test'
     TESTING = True
+    PREFS_MAX_AGE = 60
+    NOTIFY_LISTEN = False
+    EXPORT_MARK_LAG = 0
+    LOG_SINK_ENABLED = False
+    SPOOL_PATH = None
+    TWILIO_CALLS_PER_SECOND = None
 
 
 class ProductionConfig(Config):
@@ -1,12 +1,16 @@
 import os
-from app import create_app, create_prefs, register_blueprints
+from app import create_app, create_prefs, register_blueprints, start_listener, start_log_sink, start_spool
 from app.models import db
+from app.auth import revoke_tokens
 from flask_migrate import Migrate
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
 
 create_prefs(app)
 register_blueprints(app)
+start_listener(app)
+start_log_sink(app)
+start_spool(app)
 
 migrate = Migrate(app, db)
 
@@ -14,3 +18,9 @@ migrate = Migrate(app, db)
 @app.shell_context_processor
 def make_shell_context():
     return dict(db=db)
+
+
+@app.cli.command('revoke-tokens')
+def revoke_tokens_command():
+    '''Stop trusting roles in existing JWTs, e.g. after changing a user's roles'''
+    revoke_tokens()
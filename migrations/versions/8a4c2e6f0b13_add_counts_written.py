@@ -0,0 +1,31 @@
+"""add counts.written, the write time export marks and ETags use
+
+Revision ID: 8a4c2e6f0b13
+Revises: 5d1f9b3e7a60
+Create Date: 2026-10-18 09:27:40.118502
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4c2e6f0b13'
+down_revision = '5d1f9b3e7a60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('counts', sa.Column('written', sa.DateTime(timezone=True), nullable=True))
+    # until now every count was written when it was reported
+    op.execute('UPDATE counts SET written = time')
+    op.alter_column('counts', 'written', nullable=False, server_default=sa.text('now()'))
+    op.drop_index('ix_counts_time', table_name='counts')
+    op.create_index('ix_counts_written', 'counts', ['written'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_counts_written', table_name='counts')
+    op.create_index('ix_counts_time', 'counts', ['time'], unique=False)
+    op.drop_column('counts', 'written')
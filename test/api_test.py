@@ -1,12 +1,23 @@
+import gzip
+import io
+import json
+import os
+from collections import namedtuple
 from datetime import date, timedelta
+import pendulum
 import pytest
+from pyarrow import parquet
+from sqlalchemy import Integer, text
 from unittest.mock import Mock, patch
 from flask import g
-from flask_jwt_simple import create_jwt
-from app.models import Shelter
+from flask_jwt_simple import create_jwt, decode_jwt
+from app.models import Shelter, User, Log
+from app.auth import revoke_tokens, user_cache
+from app.cache import history_cache
 from app import db
-from app.models import Count
+from app.models import Count, DailyTotal
 from app.api.decorators import add_user, role_required
+from app.api.export import csv_lines, parquet_chunks
 from app.exceptions import UnauthorizedUse
 
 
@@ -193,6 +204,7 @@ def test_set_count(app_with_envion_DB, counts):
     count = Count.query.filter_by(day=yesterday, shelter_id=1).first()
     assert rv.status_code == 200
     assert count.personcount == 66
+    assert rv.get_json()['counts']['bedcount'] == count.bedcount
 
 
 def test_delete_count(app_with_envion_DB, counts):
@@ -209,3 +221,640 @@ def test_delete_count(app_with_envion_DB, counts):
     count = Count.query.filter_by(day=yesterday, shelter_id=1).first()
     assert rv.status_code == 200
     assert count is None
+
+
+def login(client, user):
+    rv = client.post('/api/admin_login/', json={"user": user, "password": "password"})
+    return rv.get_json()['jwt']
+
+
+def test_login_jwt_has_roles(app_with_envion_DB):
+    '''Tokens from login should carry the user's roles as claims'''
+    client = app_with_envion_DB.test_client()
+    token = login(client, 'admin')
+    claims = decode_jwt(token)
+    assert claims['sub'] == 'admin'
+    assert claims['roles'] == ['admin']
+
+
+def test_role_claims_skip_user_lookup(app_with_envion_DB):
+    '''Role claims in the token should authorize without querying users'''
+    client = app_with_envion_DB.test_client()
+    token = login(client, 'admin')
+    with patch('app.auth.User') as user_mock:
+        rv = client.get('/api/shelters/', headers={"Authorization": "Bearer " + token})
+    assert rv.status_code == 200
+    user_mock.query.options.assert_not_called()
+
+
+def test_revoked_role_claims(app_with_envion_DB):
+    '''After revoke_tokens() role claims should be ignored and roles read from the DB'''
+    client = app_with_envion_DB.test_client()
+    token = login(client, 'admin')
+    admin = User.query.filter_by(username='admin').one()
+    admin.roles = []
+    db.session.commit()
+    revoke_tokens()
+
+    rv = client.get('/api/shelters/', headers={"Authorization": "Bearer " + token})
+    assert rv.status_code == 403
+
+
+def test_untrusted_role_claims(app_with_envion_DB):
+    '''Role claims should not be used when JWT_TRUST_ROLE_CLAIMS is off'''
+    app_with_envion_DB.config['JWT_TRUST_ROLE_CLAIMS'] = False
+    client = app_with_envion_DB.test_client()
+    token = login(client, 'admin')
+    admin = User.query.filter_by(username='admin').one()
+    admin.roles = []
+    db.session.commit()
+
+    rv = client.get('/api/shelters/', headers={"Authorization": "Bearer " + token})
+    assert rv.status_code == 403
+
+
+@patch('flask_jwt_simple.get_jwt_identity')
+def test_user_cache(jwtMock, app_with_envion_DB):
+    '''Users should be read from the DB once and then served from the cache'''
+    jwtMock.return_value = 'admin'
+    f = Mock()
+    role_required(['admin'])(f)()
+    with patch('app.auth.User') as user_mock:
+        role_required(['admin'])(f)()
+        user_mock.query.options.assert_not_called()
+    assert user_cache.stats()['hits'] == 1
+
+
+@patch('flask_jwt_simple.get_jwt_identity')
+def test_user_cache_evicted_on_role_change(jwtMock, app_with_envion_DB):
+    '''Changing a user's roles should evict them from the cache'''
+    jwtMock.return_value = 'admin'
+    f = Mock()
+    role_required(['admin'])(f)()
+    admin = User.query.filter_by(username='admin').one()
+    admin.roles = []
+    db.session.commit()
+    with pytest.raises(UnauthorizedUse):
+        role_required(['admin'])(f)()
+
+
+@patch('flask_jwt_simple.get_jwt_identity')
+def test_role_required_inactive_user(jwtMock, app_with_envion_DB):
+    '''@role_required() should raise Unauthorized for inactive users'''
+    jwtMock.return_value = 'admin'
+    admin = User.query.filter_by(username='admin').one()
+    admin.active = False
+    db.session.commit()
+    f = Mock()
+    with pytest.raises(UnauthorizedUse):
+        role_required(['admin'])(f)()
+
+
+def test_counts_cached(app_with_envion_DB, counts):
+    '''A second request for the same board should not query the DB'''
+    client = app_with_envion_DB.test_client()
+    first = client.get('/api/counts/')
+    with patch('app.api.views.db') as db_mock:
+        second = client.get('/api/counts/')
+        db_mock.session.query.assert_not_called()
+    assert first.get_json() == second.get_json()
+
+
+def test_counts_cached_per_audience(app_with_envion_DB, counts):
+    '''Admins and the public should not share a cached board'''
+    client = app_with_envion_DB.test_client()
+    client.get('/api/counts/')
+    jwt = create_jwt(identity='admin')
+    rv = client.get('/api/counts/', headers={"Authorization": "Bearer " + jwt})
+    assert all('capacity' in count for count in rv.get_json()['counts'])
+
+
+def test_counts_cache_evicted_on_set_count(app_with_envion_DB, counts):
+    '''Setting a count should evict the cached board for that day'''
+    client = app_with_envion_DB.test_client()
+    yesterday = (date.today() - timedelta(days=1))
+    client.get(f"/api/counts/{yesterday.strftime('%Y%m%d')}")
+    jwt = create_jwt(identity='admin')
+    client.post(
+        '/api/setcount/',
+        json={"numberOfPeople": 66, "shelterID": 1, "day": yesterday},
+        headers={"Authorization": "Bearer " + jwt}
+    )
+    rv = client.get(f"/api/counts/{yesterday.strftime('%Y%m%d')}")
+    assert any(count['personcount'] == 66 and count['id'] == 1 for count in rv.get_json()['counts'])
+
+
+def test_counts_etag(app_with_envion_DB, counts):
+    '''/api/counts/ should return 304 when the ETag still matches'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/counts/')
+    etag = rv.headers['ETag']
+    assert rv.headers['Last-Modified']
+    rv = client.get('/api/counts/', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+
+
+def test_counts_etag_changes(app_with_envion_DB, counts):
+    '''Writing a count should change the ETag of that day's board'''
+    client = app_with_envion_DB.test_client()
+    yesterday = (date.today() - timedelta(days=1))
+    url = f"/api/counts/{yesterday.strftime('%Y%m%d')}"
+    etag = client.get(url).headers['ETag']
+    jwt = create_jwt(identity='admin')
+    client.post(
+        '/api/setcount/',
+        json={"numberOfPeople": 66, "shelterID": 1, "day": yesterday},
+        headers={"Authorization": "Bearer " + jwt}
+    )
+    rv = client.get(url, headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+
+
+def test_counthistory_not_modified(app_with_envion_DB, counts):
+    '''/api/counthistory/ should support If-Modified-Since and If-None-Match'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/counthistory/')
+    rv2 = client.get('/api/counthistory/', headers={'If-Modified-Since': rv.headers['Last-Modified']})
+    assert rv2.status_code == 304
+    rv3 = client.get('/api/counthistory/', headers={'If-None-Match': rv.headers['ETag']})
+    assert rv3.status_code == 304
+
+
+def test_shelters_etag(app_with_envion_DB, test_shelters):
+    '''/api/shelters/ should return 304 until a shelter changes'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    jwt = create_jwt(identity='admin')
+    headers = {"Authorization": "Bearer " + jwt}
+    client = app_with_envion_DB.test_client()
+    etag = client.get('/api/shelters/', headers=headers).headers['ETag']
+    assert client.get('/api/shelters/', headers={**headers, 'If-None-Match': etag}).status_code == 304
+
+    Shelter.query.get(1).capacity = 50
+    db.session.commit()
+    assert client.get('/api/shelters/', headers={**headers, 'If-None-Match': etag}).status_code == 200
+
+
+def test_counthistory_immutable_page(app_with_envion_DB, counts):
+    '''Pages of closed days should be cached, but clients should revalidate them'''
+    client = app_with_envion_DB.test_client()
+    first = client.get('/api/counthistory/1/')
+    assert first.cache_control.no_cache
+    assert first.cache_control.max_age is None
+    with patch('app.api.views.db') as db_mock:
+        second = client.get('/api/counthistory/1/', headers={'If-None-Match': first.headers['ETag']})
+        db_mock.session.query.assert_not_called()
+    assert second.status_code == 304
+    assert first.get_json() == client.get('/api/counthistory/1/').get_json()
+
+
+def test_counthistory_range_max_age(app_with_envion_DB, counts):
+    '''Only date-addressed ranges of closed days should be sent with a long max-age'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/counthistory/range/?to=2019-01-01')
+    assert rv.cache_control.max_age == app_with_envion_DB.config['COUNTHISTORY_MAX_AGE']
+    rv = client.get('/api/counthistory/range/')
+    assert rv.cache_control.max_age is None
+
+
+def test_counthistory_current_page_not_cached(app_with_envion_DB, counts):
+    '''The page including the current service day should make clients revalidate'''
+    noon = pendulum.today('America/Anchorage').add(hours=12)
+    client = app_with_envion_DB.test_client()
+    with patch('pendulum.now', return_value=noon):
+        rv = client.get('/api/counthistory/')
+    assert rv.cache_control.no_cache
+    assert rv.cache_control.max_age is None
+
+
+def test_counthistory_purged_on_set_count(app_with_envion_DB, counts):
+    '''Correcting a count should purge only the cached pages that include its day'''
+    client = app_with_envion_DB.test_client()
+    client.get('/api/counthistory/1/')
+    client.get('/api/counthistory/2/')
+    assert len(history_cache) == 2
+
+    day = date.today() - timedelta(days=20)
+    jwt = create_jwt(identity='admin')
+    client.post(
+        '/api/setcount/',
+        json={"numberOfPeople": 66, "shelterID": 1, "day": day},
+        headers={"Authorization": "Bearer " + jwt}
+    )
+    assert len(history_cache) == 1
+    rv = client.get('/api/counthistory/1/')
+    shelter = next(s for s in rv.get_json()['shelters'] if s['label'] == 'test_shelter_1')
+    assert 66 in shelter['data']
+
+
+def test_daily_totals(app_with_envion_DB, counts):
+    '''daily_totals should hold network-wide totals for each day'''
+    yesterday = date.today() - timedelta(days=1)
+    total = DailyTotal.query.get((yesterday, 'visible'))
+    assert total.shelters == 2
+    assert total.personcount == 30
+    assert total.bedcount == 63
+    assert total.capacity == 93
+
+
+def test_daily_totals_follow_counts(app_with_envion_DB, counts):
+    '''Changing or deleting counts should update that day's totals'''
+    yesterday = date.today() - timedelta(days=1)
+    count = Count.query.get((yesterday, 1))
+    count.personcount = 50
+    count.bedcount = 1
+    db.session.commit()
+    assert DailyTotal.query.get((yesterday, 'visible')).personcount == 60
+
+    Count.query.filter_by(day=yesterday).delete()
+    db.session.commit()
+    assert DailyTotal.query.get((yesterday, 'visible')).shelters == 0
+
+
+def test_daily_totals_public_scope(app_with_envion_DB, counts):
+    '''Making a shelter private should remove it from the public totals'''
+    yesterday = date.today() - timedelta(days=1)
+    Shelter.query.get(2).public = False
+    db.session.commit()
+    assert DailyTotal.query.get((yesterday, 'public')).personcount == 20
+    assert DailyTotal.query.get((yesterday, 'visible')).personcount == 30
+
+
+def test_counthistory_series(app_with_envion_DB, counts):
+    '''counthistory should align each shelter's counts and the totals with the dates'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/counthistory/')
+    data = rv.get_json()
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    i = data['dates'].index(yesterday)
+    shelters = {s['id']: s for s in data['shelters']}
+    assert shelters[1]['data'][i] == 20
+    assert shelters[2]['data'][i] == 10
+    assert data['totals']['personcount'][i] == 30
+    assert data['totals']['personcount'][0] is None
+
+
+def test_counthistory_range(app_with_envion_DB, counts):
+    '''The range endpoint should return daily points for short ranges'''
+    client = app_with_envion_DB.test_client()
+    start = (date.today() - timedelta(days=6)).isoformat()
+    end = date.today().isoformat()
+    rv = client.get(f'/api/counthistory/range/?from={start}&to={end}')
+    data = rv.get_json()
+    assert data['bucket'] == 'day'
+    assert len(data['dates']) == 7
+    i = data['dates'].index((date.today() - timedelta(days=1)).isoformat())
+    assert data['totals']['personcount'][i] == 30
+
+
+def test_counthistory_range_one_shelter(app_with_envion_DB, counts):
+    '''The range endpoint should limit the series to the given shelter'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/counthistory/range/?shelter=2')
+    data = rv.get_json()
+    assert [s['id'] for s in data['shelters']] == [2]
+
+
+def test_counthistory_range_downsampled(app_with_envion_DB, counts):
+    '''Long ranges should be downsampled to stay within the point budget'''
+    client = app_with_envion_DB.test_client()
+    start = (date.today() - timedelta(days=400)).isoformat()
+    rv = client.get(f'/api/counthistory/range/?from={start}')
+    data = rv.get_json()
+    assert data['bucket'] == 'week'
+    assert len(data['dates']) <= app_with_envion_DB.config['HISTORY_POINT_BUDGET']
+    shelter = next(s for s in data['shelters'] if s['id'] == 1)
+    assert 20 in shelter['data']
+
+
+def test_counthistory_range_bad_params(app_with_envion_DB):
+    '''The range endpoint should reject unparseable or reversed ranges'''
+    client = app_with_envion_DB.test_client()
+    assert client.get('/api/counthistory/range/?from=yesterday-ish').status_code == 400
+    assert client.get('/api/counthistory/range/?from=2020-02-01&to=2020-01-01').status_code == 400
+
+
+def test_logs_cursor(app_with_envion_DB, test_shelters):
+    '''Following the next cursor should page through every log once, newest first'''
+    db.session.add(Shelter(**test_shelters[0]))
+    start = pendulum.datetime(2019, 5, 20, 22)
+    for i in range(20):
+        db.session.add(Log(shelter_id=1, action='save_count', time=start.add(minutes=i)))
+    # two logs at the same time are ordered by id
+    db.session.add(Log(shelter_id=1, action='save_count', time=start))
+    db.session.commit()
+
+    client = app_with_envion_DB.test_client()
+    jwt = create_jwt(identity='admin')
+    headers = {"Authorization": "Bearer " + jwt}
+    first = client.get('/api/logs/1/', headers=headers).get_json()
+    assert len(first['logs']) == 15
+    assert first['next']
+
+    second = client.get('/api/logs/1/', query_string={'before': first['next']}, headers=headers).get_json()
+    assert len(second['logs']) == 6
+    assert second['next'] is None
+    ids = [log['id'] for log in first['logs'] + second['logs']]
+    assert len(set(ids)) == 21
+
+
+def test_logs_bad_cursor(app_with_envion_DB, test_shelters):
+    '''An unparseable cursor should be rejected'''
+    db.session.add(Shelter(**test_shelters[0]))
+    db.session.commit()
+    client = app_with_envion_DB.test_client()
+    jwt = create_jwt(identity='admin')
+    rv = client.get('/api/logs/1/?before=nope', headers={"Authorization": "Bearer " + jwt})
+    assert rv.status_code == 400
+
+
+def test_log_counters(app_with_envion_DB, test_shelters):
+    '''Inserting logs, one at a time or in a batch, should keep the per-shelter counters'''
+    db.session.add(Shelter(**test_shelters[0]))
+    db.session.add(Shelter(**test_shelters[1]))
+    db.session.commit()
+    db.session.add(Log(shelter_id=1, action='save_count'))
+    db.session.commit()
+    db.session.add_all([
+        Log(shelter_id=1, action='validate_shelter'),
+        Log(shelter_id=1, action='save_count', error='bad count'),
+        Log(shelter_id=2, action='validate_shelter'),
+        Log(action='start_call')
+    ])
+    db.session.commit()
+
+    client = app_with_envion_DB.test_client()
+    jwt = create_jwt(identity='admin')
+    headers = {"Authorization": "Bearer " + jwt}
+    rv = client.get('/api/logs/1/', headers=headers).get_json()
+    assert rv['total_calls'] == 3
+    assert rv['calls'] == {'total': 3, 'errors': 1, 'save_count': 2, 'validate_shelter': 1}
+
+    shelters = {s['id']: s for s in client.get('/api/shelters/', headers=headers).get_json()}
+    assert shelters[2]['calls'] == {'total': 1, 'errors': 0, 'save_count': 0, 'validate_shelter': 1}
+
+
+def test_shelters_etag_changes_with_calls(app_with_envion_DB, test_shelters):
+    '''A new log should change the shelters ETag since it changes the call counters'''
+    db.session.add(Shelter(**test_shelters[0]))
+    db.session.commit()
+    client = app_with_envion_DB.test_client()
+    jwt = create_jwt(identity='admin')
+    headers = {"Authorization": "Bearer " + jwt}
+    etag = client.get('/api/shelters/', headers=headers).headers['ETag']
+
+    db.session.add(Log(shelter_id=1, action='save_count'))
+    db.session.commit()
+    rv = client.get('/api/shelters/', headers=dict(headers, **{'If-None-Match': etag}))
+    assert rv.status_code == 200
+    assert rv.get_json()[0]['calls']['total'] == 1
+
+
+def test_export_streams_csv(app_with_envion_DB, counts):
+    '''The export should stream every count as CSV in day order'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/exportkey/export/')
+    assert rv.status_code == 200
+    assert rv.is_streamed
+    assert rv.mimetype == 'text/csv'
+    assert 'attachment; filename=shelterCounts.csv' == rv.headers['Content-Disposition']
+    lines = rv.get_data(as_text=True).splitlines()
+    assert lines[0] == 'day,name,personcount,bedcount,shelter_id'
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    assert lines[1:] == [
+        f'{yesterday},test_shelter_1,20,31,1',
+        f'{yesterday},test_shelter_2,10,32,2',
+        f'{date.today().isoformat()},test_shelter_1,20,100,1'
+    ]
+
+
+def test_export_public_hides_private_shelters(app_with_envion_DB, counts):
+    '''The public export should leave out shelters that aren't public'''
+    Shelter.query.get(2).public = False
+    db.session.commit()
+    client = app_with_envion_DB.test_client()
+    lines = client.get('/api/pubkey/export/').get_data(as_text=True).splitlines()
+    assert len(lines) == 3
+    assert all('test_shelter_2' not in line for line in lines)
+
+
+def test_csv_lines_batches():
+    '''Rows should be sent in chunks of batch_size after the header'''
+    Row = namedtuple('Row', ['a', 'b'])
+    chunks = list(csv_lines((Row(i, None) for i in range(5)), ['a', 'b'], batch_size=2))
+    assert chunks == [b'a,b\r\n', b'0,\r\n1,\r\n', b'2,\r\n3,\r\n', b'4,\r\n']
+
+
+def test_export_since_watermark(app_with_envion_DB, counts):
+    '''Passing the high-water mark back as since should return only newer counts'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/exportkey/export/')
+    rv.get_data()
+    mark = rv.headers['X-High-Water-Mark']
+
+    rv = client.get('/api/exportkey/export/', query_string={'since': mark})
+    assert rv.get_data(as_text=True).splitlines() == ['day,name,personcount,bedcount,shelter_id']
+    assert rv.headers['X-High-Water-Mark'] == mark
+
+    db.session.add(Count(shelter_id=2, day=date.today().isoformat(), bedcount=5, personcount=7))
+    db.session.commit()
+    rv = client.get('/api/exportkey/export/', query_string={'since': mark})
+    lines = rv.get_data(as_text=True).splitlines()
+    assert lines[1:] == [f'{date.today().isoformat()},test_shelter_2,7,5,2']
+    assert rv.headers['X-High-Water-Mark'] > mark
+
+
+def test_export_mark_lag(app_with_envion_DB, counts):
+    '''Counts written within the lag should be left for the next export, not skipped by it'''
+    app_with_envion_DB.config['EXPORT_MARK_LAG'] = 60
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/exportkey/export/')
+    assert rv.get_data(as_text=True).splitlines() == ['day,name,personcount,bedcount,shelter_id']
+    assert 'X-High-Water-Mark' not in rv.headers
+
+    db.session.execute(text("UPDATE counts SET written = now() - interval '2 minutes' WHERE shelter_id = 1"))
+    # as if its transaction were still committing when the export read the mark
+    db.session.execute(text("UPDATE counts SET written = now() - interval '30 seconds' WHERE shelter_id = 2"))
+    db.session.commit()
+    rv = client.get('/api/exportkey/export/')
+    rows = rv.get_data(as_text=True).splitlines()[1:]
+    assert rows and all(row.endswith(',1') for row in rows)
+    mark = rv.headers['X-High-Water-Mark']
+
+    app_with_envion_DB.config['EXPORT_MARK_LAG'] = 0
+    rv = client.get('/api/exportkey/export/', query_string={'since': mark})
+    rows = rv.get_data(as_text=True).splitlines()[1:]
+    assert rows and all(row.endswith(',2') for row in rows)
+
+
+def test_export_filters(app_with_envion_DB, counts):
+    '''Exports should be limited to the requested days and shelter'''
+    client = app_with_envion_DB.test_client()
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    rv = client.get('/api/exportkey/export/', query_string={'to_day': yesterday})
+    assert len(rv.get_data(as_text=True).splitlines()) == 3
+
+    rv = client.get('/api/exportkey/export/', query_string={'from_day': yesterday, 'shelter_id': 1})
+    assert len(rv.get_data(as_text=True).splitlines()) == 3
+
+    rv = client.get('/api/exportkey/export/', query_string={'from_day': date.today().isoformat(), 'shelter_id': 2})
+    assert len(rv.get_data(as_text=True).splitlines()) == 1
+    assert 'X-High-Water-Mark' not in rv.headers
+
+
+def test_export_bad_filter(app_with_envion_DB, counts):
+    '''Unparseable filters should be rejected'''
+    client = app_with_envion_DB.test_client()
+    assert client.get('/api/exportkey/export/?since=nope').status_code == 400
+    assert client.get('/api/exportkey/export/?shelter_id=x').status_code == 400
+
+
+def test_export_gzip_csv(app_with_envion_DB, counts):
+    '''?format=csv.gz should send the same CSV gzipped'''
+    client = app_with_envion_DB.test_client()
+    plain = client.get('/api/exportkey/export/').get_data()
+    rv = client.get('/api/exportkey/export/?format=csv.gz')
+    assert rv.mimetype == 'application/gzip'
+    assert rv.headers['Content-Disposition'] == 'attachment; filename=shelterCounts.csv.gz'
+    assert gzip.decompress(rv.get_data()) == plain
+
+
+def test_export_ndjson_from_accept(app_with_envion_DB, counts):
+    '''An Accept header should choose the format when ?format= is missing'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/exportkey/export/', headers={'Accept': 'application/x-ndjson'})
+    assert rv.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+    assert rows[0] == {
+        'day': (date.today() - timedelta(days=1)).isoformat(),
+        'name': 'test_shelter_1',
+        'personcount': 20,
+        'bedcount': 31,
+        'shelter_id': 1
+    }
+    assert len(rows) == 3
+
+
+def test_export_parquet(app_with_envion_DB, counts):
+    '''Parquet exports should keep the column types'''
+    client = app_with_envion_DB.test_client()
+    rv = client.get('/api/exportkey/export/?format=parquet')
+    assert rv.mimetype == 'application/vnd.apache.parquet'
+    table = parquet.read_table(io.BytesIO(rv.get_data()))
+    assert table.column_names == ['day', 'name', 'personcount', 'bedcount', 'shelter_id']
+    assert str(table.schema.field('day').type) == 'date32[day]'
+    assert table.column('bedcount').to_pylist() == [31, 32, 100]
+
+
+def test_export_unknown_format(app_with_envion_DB, counts):
+    '''Unknown formats should be rejected'''
+    client = app_with_envion_DB.test_client()
+    assert client.get('/api/exportkey/export/?format=xlsx').status_code == 400
+
+
+def test_parquet_chunks_row_groups():
+    '''Each batch should be written as its own row group as soon as it is encoded'''
+    Row = namedtuple('Row', ['a', 'b'])
+    chunks = list(parquet_chunks((Row(i, None) for i in range(5)), ['a', 'b'], batch_size=2, types={'a': Integer()}))
+    assert all(chunks[:-1])
+    parsed = parquet.ParquetFile(io.BytesIO(b''.join(chunks)))
+    assert parsed.num_row_groups == 3
+    assert parsed.read().column('a').to_pylist() == [0, 1, 2, 3, 4]
+
+
+CRON = {'X-Appengine-Cron': 'true'}
+
+
+def test_snapshot_build_needs_cron(app_with_envion_DB, counts, tmp_path):
+    '''Only App Engine cron may build snapshots'''
+    app_with_envion_DB.config['EXPORT_SNAPSHOT_DIR'] = str(tmp_path)
+    client = app_with_envion_DB.test_client()
+    assert client.get('/api/snapshots/build/').status_code == 401
+    assert client.get('/api/exportkey/export/snapshot/').status_code == 404
+
+
+def test_snapshot_serves_export(app_with_envion_DB, counts, tmp_path):
+    '''The base segment should hold the same CSV as the export and support ranges and ETags'''
+    app_with_envion_DB.config['EXPORT_SNAPSHOT_DIR'] = str(tmp_path)
+    client = app_with_envion_DB.test_client()
+    assert client.get('/api/snapshots/build/?full=1', headers=CRON).get_json()['success']
+
+    manifest = client.get('/api/exportkey/export/snapshot/').get_json()
+    assert len(manifest['segments']) == 1
+    base = manifest['segments'][0]
+    assert base['rows'] == 3
+
+    rv = client.get('/api/exportkey/export/snapshot/' + base['file'])
+    assert rv.get_data() == client.get('/api/exportkey/export/').get_data()
+    assert rv.headers['Accept-Ranges'] == 'bytes'
+
+    partial = client.get('/api/exportkey/export/snapshot/' + base['file'], headers={'Range': 'bytes=0-2'})
+    assert partial.status_code == 206
+    assert partial.get_data() == b'day'
+
+    cached = client.get('/api/exportkey/export/snapshot/' + base['file'], headers={'If-None-Match': rv.headers['ETag']})
+    assert cached.status_code == 304
+    assert client.get('/api/exportkey/export/snapshot/manifest.json').status_code == 404
+
+
+def test_snapshot_deltas(app_with_envion_DB, counts, tmp_path):
+    '''New counts should be appended as deltas until the next full build'''
+    app_with_envion_DB.config['EXPORT_SNAPSHOT_DIR'] = str(tmp_path)
+    client = app_with_envion_DB.test_client()
+    client.get('/api/snapshots/build/', headers=CRON)
+    # nothing new, nothing written
+    client.get('/api/snapshots/build/', headers=CRON)
+    assert len(client.get('/api/exportkey/export/snapshot/').get_json()['segments']) == 1
+
+    Shelter.query.get(2).public = False
+    db.session.add(Count(shelter_id=2, day=date.today().isoformat(), bedcount=5, personcount=7))
+    db.session.commit()
+    client.get('/api/snapshots/build/', headers=CRON)
+    manifest = client.get('/api/exportkey/export/snapshot/').get_json()
+    assert [s['rows'] for s in manifest['segments']] == [3, 1]
+    delta = client.get('/api/exportkey/export/snapshot/' + manifest['segments'][1]['file'])
+    assert delta.get_data(as_text=True).splitlines()[1:] == [f'{date.today().isoformat()},test_shelter_2,7,5,2']
+    public = client.get('/api/pubkey/export/snapshot/').get_json()
+    assert len(public['segments']) == 1
+
+    client.get('/api/snapshots/build/?full=1', headers=CRON)
+    manifest = client.get('/api/exportkey/export/snapshot/').get_json()
+    assert [s['rows'] for s in manifest['segments']] == [4]
+    assert sorted(os.listdir(tmp_path / 'all')) == sorted(['manifest.json', manifest['segments'][0]['file']])
+    # the full build also picks up that shelter 2 is no longer public
+    public = client.get('/api/pubkey/export/snapshot/').get_json()
+    assert [s['rows'] for s in public['segments']] == [2]
+
+
+def test_snapshot_rebuild_renames_changed_segment(app_with_envion_DB, counts, tmp_path):
+    '''A full build at the same mark with different rows should not reuse the segment's name'''
+    app_with_envion_DB.config['EXPORT_SNAPSHOT_DIR'] = str(tmp_path)
+    client = app_with_envion_DB.test_client()
+    client.get('/api/snapshots/build/?full=1', headers=CRON)
+    before = client.get('/api/exportkey/export/snapshot/').get_json()['segments'][0]
+    client.get('/api/snapshots/build/?full=1', headers=CRON)
+    assert client.get('/api/exportkey/export/snapshot/').get_json()['segments'][0]['file'] == before['file']
+
+    Shelter.query.get(2).name = 'renamed_shelter'
+    db.session.commit()
+    client.get('/api/snapshots/build/?full=1', headers=CRON)
+    after = client.get('/api/exportkey/export/snapshot/').get_json()
+    assert after['mark'] == before['mark']
+    assert after['segments'][0]['file'] != before['file']
+    assert client.get('/api/exportkey/export/snapshot/' + before['file']).status_code == 404
+    rv = client.get('/api/exportkey/export/snapshot/' + after['segments'][0]['file'])
+    assert 'renamed_shelter' in rv.get_data(as_text=True)
+
+
+def test_metrics(app_with_envion_DB):
+    '''Admins should see the outbound request and cache counters'''
+    client = app_with_envion_DB.test_client()
+    assert client.get('/api/metrics/', headers={"Authorization": "Bearer " + create_jwt(identity='visitor')}).status_code == 403
+    rv = client.get('/api/metrics/', headers={"Authorization": "Bearer " + create_jwt(identity='admin')})
+    data = rv.get_json()
+    assert set(data['twilio']) >= {'requests', 'failures', 'timeouts', 'skipped', 'circuit_opened', 'latency'}
+    assert set(data['log_sink']) >= {'running', 'depth', 'queued', 'written', 'failed', 'spooled', 'batches', 'sync_writes'}
+    assert set(data['spool']) == {'enabled', 'pending', 'spooled', 'replayed', 'dropped', 'last_error'}
+    assert set(data['caches']) == {'counts', 'counthistory', 'users'}
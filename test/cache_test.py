@@ -0,0 +1,61 @@
+from unittest.mock import patch
+from app.cache import TTLCache
+
+
+def test_cache_get_set():
+    '''Values should be returned until evicted'''
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    cache.evict('a')
+    assert cache.get('a') is None
+
+
+def test_cache_lru():
+    '''The least recently used entry should be dropped when the cache is full'''
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+@patch('time.monotonic')
+def test_cache_ttl(monotonic_mock):
+    '''Entries should expire after their ttl'''
+    monotonic_mock.return_value = 100
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=100)
+    monotonic_mock.return_value = 111
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+def test_cache_evict_where():
+    '''evict_where should drop only matching entries'''
+    cache = TTLCache(maxsize=10)
+    for i in range(5):
+        cache.set(i, i * 10)
+    cache.evict_where(lambda k, v: v >= 30)
+    assert len(cache) == 3
+    assert cache.get(4) is None
+
+
+def test_cache_stats():
+    '''Hits and misses should be counted'''
+    cache = TTLCache(maxsize=10)
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+    assert cache.stats() == {"size": 1, "maxsize": 10, "hits": 1, "misses": 1}
+
+
+def test_cache_disabled():
+    '''A cache with maxsize 0 should not store anything'''
+    cache = TTLCache(maxsize=0)
+    cache.set('a', 1)
+    assert cache.get('a') is None
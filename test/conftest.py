@@ -1,3 +1,4 @@
 from .fixtures.app_fixtures import client, app_with_envion_DB, app_with_envion, environ, db_environ   # noqa: [E401]
 from .fixtures.shelter_fixtures import inactive_shelter, test_shelters, shelter_no_number, shelter_empty_number  # noqa: [E401]
-from .fixtures.counts_fixtures import counts  # noqa: [E401]
\ No newline at end of file
+from .fixtures.counts_fixtures import counts  # noqa: [E401]
+from .fixtures.twilio_fixtures import fake_twilio  # noqa: [E401]
@@ -0,0 +1,48 @@
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+
+class FakeStudioHandler(BaseHTTPRequestHandler):
+    '''
+    Stands in for the Twilio Studio executions API over keep-alive connections.
+    The server's `respond(form)` decides the (status, delay in seconds) of each answer.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        form = dict(urllib.parse.parse_qsl(body.decode()))
+        self.server.requests.append((self.client_address, self.path, self.headers['Authorization'], form))
+        status, delay = self.server.respond(form)
+        if delay:
+            time.sleep(delay)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_twilio(monkeypatch):
+    '''
+    A local Twilio Studio server. The flow base URL in the environment points at it,
+    so start_call dials it instead of Twilio.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeStudioHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.respond = lambda form: (201, 0)
+    server.base_url = 'http://127.0.0.1:%d/v1/Flows/' % server.server_port
+    monkeypatch.setenv('TWILIO_FLOW_BASE_URL', server.base_url)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,90 @@
+import threading
+from unittest.mock import patch
+import pytest
+from app import db
+from app.models import Shelter, Log
+from app.twilio_api.logsink import LogSink
+
+
+@pytest.fixture
+def log_sink(app_with_envion_DB, test_shelters):
+    '''The log sink running for the test app, flushing quickly'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    app_with_envion_DB.config.update(
+        LOG_SINK_BATCH_SIZE=100,
+        LOG_SINK_FLUSH_INTERVAL=0.05,
+        LOG_SINK_MAX_QUEUE=100,
+        LOG_SINK_PUT_TIMEOUT=0.01)
+    LogSink.reset()
+    LogSink.start(app_with_envion_DB)
+    yield LogSink
+    LogSink.stop()
+    LogSink.reset()
+
+
+def test_sink_writes_batches(app_with_envion_DB, log_sink, test_shelters):
+    '''Webhook logs should be written in multi-row batches, all of them by the time the sink stops'''
+    client = app_with_envion_DB.test_client()
+    for _ in range(20):
+        rv = client.post('/twilio/validate_shelter/', data={'shelterID': test_shelters[0]['login_id']})
+        assert rv.get_json()['success'] is True
+    log_sink.stop()
+
+    assert db.session.query(Log).count() == 20
+    stats = log_sink.stats()
+    assert stats['queued'] == stats['written'] == 20
+    assert stats['batches'] < 20
+    assert stats['sync_writes'] == 0
+
+
+def test_sink_keeps_good_rows(app_with_envion_DB, log_sink, test_shelters):
+    '''A row the database rejects should not take the rest of its batch with it'''
+    log_sink.write(shelter_id=test_shelters[0]['id'], action='validate_shelter')
+    log_sink.write(shelter_id=999, action='validate_shelter')
+    log_sink.write(shelter_id=test_shelters[1]['id'], action='validate_shelter')
+    log_sink.stop()
+
+    assert sorted(log.shelter_id for log in db.session.query(Log)) == sorted(s['id'] for s in test_shelters)
+    assert log_sink.stats()['failed'] == 1
+
+
+def test_sink_backpressure(app_with_envion_DB, test_shelters):
+    '''When the queue stays full a webhook should write its own log rather than queue more'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    app_with_envion_DB.config.update(
+        LOG_SINK_BATCH_SIZE=100,
+        LOG_SINK_FLUSH_INTERVAL=0.05,
+        LOG_SINK_MAX_QUEUE=1,
+        LOG_SINK_PUT_TIMEOUT=0)
+    release = threading.Event()
+    LogSink.reset()
+    # a writer stuck on the database
+    with patch.object(LogSink, '_run', lambda app: release.wait()):
+        LogSink.start(app_with_envion_DB)
+    try:
+        client = app_with_envion_DB.test_client()
+        for _ in range(3):
+            rv = client.post('/twilio/validate_shelter/', data={'shelterID': test_shelters[0]['login_id']})
+            assert rv.get_json()['success'] is True
+        stats = LogSink.stats()
+        assert (stats['queued'], stats['sync_writes'], stats['depth']) == (1, 2, 1)
+        assert db.session.query(Log).count() == 2
+    finally:
+        release.set()
+        LogSink.stop()
+        LogSink.reset()
+
+
+def test_sink_disabled_writes_synchronously(app_with_envion_DB, test_shelters):
+    '''Without the sink running, logs should be committed before the webhook responds'''
+    LogSink.reset()
+    rv = app_with_envion_DB.test_client().post('/twilio/log_failed_call/', data={'shelterID': 999, 'error': 'busy'})
+    assert rv.get_json()['success'] is False
+    rv = app_with_envion_DB.test_client().post('/twilio/log_failed_call/', data={'error': 'busy'})
+    assert rv.get_json()['success'] is True
+    assert db.session.query(Log).one().error == 'busy'
+    assert LogSink.stats()['sync_writes'] == 2
@@ -1,6 +1,11 @@
+import time
+import pendulum
 from unittest.mock import patch
+from sqlalchemy import text
 from app.prefs import Prefs
-from app.models import Pref
+from app.notify import Notifier
+from app.prefs.schedule import Schedule
+from app.models import Pref, db
 from flask_jwt_simple import create_jwt
 from .fixtures.app_fixtures import environ, db_environ
 
@@ -68,3 +73,103 @@ def test_get_defaults_good_jwt(isAdmin_mock, app_with_envion):
     assert res_data['enforce_hours'] == True
     assert res_data['open_time'] == environ['OPEN']
     assert res_data['timezone'] == environ['PEND_TZ']
+
+
+def test_prefs_cached(app_with_envion):
+    '''Reading prefs should not query the DB while the snapshot is fresh'''
+    Prefs['timezone']
+    with patch.object(Pref, 'query') as query_mock:
+        assert Prefs['timezone'] == environ['PEND_TZ']
+        assert Prefs['open_time'] == environ['OPEN']
+        query_mock.get.assert_not_called()
+
+
+def test_prefs_max_age(app_with_envion):
+    '''Changes made directly in the DB should be picked up once the snapshot is too old'''
+    p = Pref.query.get(environ['APP_NAME'])
+    p.timezone = 'testVal3'
+    db.session.commit()
+    assert Prefs['timezone'] == environ['PEND_TZ']
+
+    Prefs.max_age = 0
+    assert Prefs['timezone'] == 'testVal3'
+
+
+def test_prefs_invalidate(app_with_envion):
+    '''invalidate() should force the next read to go to the DB'''
+    p = Pref.query.get(environ['APP_NAME'])
+    p.close_time = '04:00'
+    db.session.commit()
+    Prefs.invalidate()
+    assert Prefs['close_time'] == '04:00'
+
+
+def test_prefs_update_notifies(app_with_envion):
+    '''Prefs.update should publish a notification on the prefs channel'''
+    with patch.object(Notifier, 'publish') as publish_mock:
+        Prefs.update({'open_time': '19:00'})
+    publish_mock.assert_called_with('prefs', environ['APP_NAME'])
+
+
+def test_prefs_notify_invalidates(app_with_envion):
+    '''A NOTIFY from another instance should make prefs reload the changed row'''
+    Prefs.max_age = None
+    Notifier.start(app_with_envion)
+    try:
+        # give the listener a moment to issue LISTEN
+        time.sleep(0.5)
+        with db.engine.begin() as conn:
+            conn.execute(text("UPDATE prefs SET open_time = '18:30' WHERE app_id = :app_id"), app_id=environ['APP_NAME'])
+            conn.execute(text("SELECT pg_notify('prefs', :app_id)"), app_id=environ['APP_NAME'])
+        deadline = time.monotonic() + 3
+        while Prefs['open_time'] != '18:30' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert Prefs['open_time'] == '18:30'
+    finally:
+        Notifier.stop()
+
+
+def test_schedule_service_day():
+    '''Calls after the cutoff should count toward the next day'''
+    schedule = Schedule('America/Anchorage', '20:00', '03:00', '22:00')
+    before = pendulum.datetime(2019, 5, 20, 21, 59, tz='America/Anchorage')
+    after = pendulum.datetime(2019, 5, 20, 22, 1, tz='America/Anchorage')
+    assert schedule.service_day(before).to_date_string() == '2019-05-20'
+    assert schedule.service_day(after).to_date_string() == '2019-05-21'
+
+
+def test_schedule_service_day_converts_tz():
+    '''service_day should interpret times in the schedule's timezone'''
+    schedule = Schedule('America/Anchorage', '20:00', '03:00', '22:00')
+    utc = pendulum.datetime(2019, 5, 21, 5, 0, tz='UTC')  # 21:00 in Anchorage
+    assert schedule.service_day(utc).to_date_string() == '2019-05-20'
+
+
+def test_schedule_is_open_spans_midnight():
+    '''Open hours that span midnight should include times on both sides of it'''
+    schedule = Schedule('America/Anchorage', '20:00', '03:00', '22:00')
+    assert schedule.is_open(pendulum.datetime(2019, 5, 20, 23, 0, tz='America/Anchorage'))
+    assert schedule.is_open(pendulum.datetime(2019, 5, 20, 2, 0, tz='America/Anchorage'))
+    assert not schedule.is_open(pendulum.datetime(2019, 5, 20, 12, 0, tz='America/Anchorage'))
+
+
+def test_schedule_not_enforced():
+    '''is_open should always be true when hours are not enforced'''
+    schedule = Schedule('America/Anchorage', '20:00', '03:00', '22:00', enforce_hours=False)
+    assert schedule.is_open(pendulum.datetime(2019, 5, 20, 12, 0, tz='America/Anchorage'))
+
+
+def test_schedule_hours():
+    '''Hours should be available as text and as sayable phrases'''
+    schedule = Schedule('America/Anchorage', '20:00', '03:05', '22:00')
+    assert schedule.text_hours() == 'between 8:00 PM and 3:05 AM'
+    assert schedule.spoken_hours() == "between 8 O'clock P M and 3 oh 5 A M"
+
+
+def test_prefs_schedule_rebuilt(app_with_envion):
+    '''Prefs.schedule should be reused until prefs change'''
+    schedule = Prefs.schedule
+    assert Prefs.schedule is schedule
+    Prefs['start_day'] = '21:00'
+    assert Prefs.schedule is not schedule
+    assert Prefs.schedule.cutoff.hour == 21
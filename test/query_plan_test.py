@@ -0,0 +1,115 @@
+import pytest
+from flask_jwt_simple import create_jwt
+from sqlalchemy import event, text
+from app import db
+from app.prefs import Prefs
+from app.cache import board_cache, history_cache
+
+SHELTERS = 40
+DAYS = 730
+LOGS_PER_COUNT = 3
+
+
+def seed(today):
+    '''Two years of counts and calls for a few dozen shelters, written in bulk'''
+    db.session.execute(text('''
+        INSERT INTO shelters (name, login_id, capacity, phone)
+        SELECT 'Shelter ' || i, 'login' || i, 50, '+1907555' || lpad(i::text, 4, '0')
+        FROM generate_series(1, :shelters) AS i
+    '''), {'shelters': SHELTERS})
+    # the daily_totals triggers would recount every day once per row
+    db.session.execute(text('ALTER TABLE counts DISABLE TRIGGER USER'))
+    db.session.execute(text('''
+        INSERT INTO counts (shelter_id, day, bedcount, personcount, time, written)
+        SELECT s.id, d::date, 10 + s.id % 7, 5 + s.id % 11, d + interval '23 hours', d + interval '23 hours'
+        FROM shelters s, generate_series(CAST(:today AS date) - :days + 1, CAST(:today AS date), interval '1 day') AS d
+    '''), {'today': today.to_date_string(), 'days': DAYS})
+    db.session.execute(text('ALTER TABLE counts ENABLE TRIGGER USER'))
+    db.session.execute(text('''
+        INSERT INTO logs (shelter_id, time, from_number, contact_type, action)
+        SELECT c.shelter_id, c.time + n * interval '1 minute', '+19075550000', 'SMS', 'save_count'
+        FROM counts c, generate_series(1, :per_count) AS n
+    '''), {'per_count': LOGS_PER_COUNT})
+    db.session.commit()
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+@pytest.fixture
+def captured_queries(app_with_envion_DB):
+    '''Collects the SELECT statements the app sends while the test runs'''
+    queries = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            queries.append((statement, parameters))
+
+    engine = db.get_engine(app_with_envion_DB)
+    event.listen(engine, 'before_cursor_execute', capture)
+    yield queries
+    event.remove(engine, 'before_cursor_execute', capture)
+
+
+def plan(statement, parameters):
+    connection = db.engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+    finally:
+        connection.close()
+
+
+def test_endpoint_queries_use_indexes(app_with_envion_DB, captured_queries):
+    '''No endpoint query should scan all of counts or logs to answer a request'''
+    today = Prefs.schedule.service_day()
+    seed(today)
+    board_cache.clear()
+    history_cache.clear()
+    del captured_queries[:]
+
+    client = app_with_envion_DB.test_client()
+    headers = {"Authorization": "Bearer " + create_jwt(identity='admin')}
+    past = today.subtract(days=100)
+    urls = [
+        '/api/counts/',
+        f"/api/counts/{past.format('YYYYMMDD')}",
+        '/api/counthistory/',
+        '/api/counthistory/3/',
+        f"/api/counthistory/range/?from={past.to_date_string()}&to={today.to_date_string()}&shelter=7",
+        '/api/shelters/',
+        '/api/logs/7/',
+        '/api/logs/7/4/',
+        # every shelter has a count today, so no calls are started
+        '/twilio/start_call/',
+        f"/api/exportkey/export/?since={today.subtract(days=2).add(hours=23).isoformat().replace('+', '%2B')}",
+        '/api/exportkey/export/?shelter_id=7&from_day=' + past.to_date_string()
+    ]
+    for url in urls:
+        rv = client.get(url, headers=headers)
+        assert rv.status_code == 200, url
+        # exports stream, so their queries run as the body is read
+        rv.get_data()
+
+    next_page = client.get('/api/logs/7/', headers=headers).get_json()['next']
+    assert client.get('/api/logs/7/', query_string={'before': next_page}, headers=headers).status_code == 200
+
+    assert captured_queries
+    for statement, parameters in captured_queries:
+        explained = plan(statement, parameters)
+        assert 'Seq Scan on counts' not in explained, statement
+        assert 'Seq Scan on logs' not in explained, statement
+
+
+def test_shelter_lookups_use_indexes(app_with_envion_DB):
+    '''
+    Changing a shelter's visibility recounts its days and deleting it cascades
+    to its counts and logs; those lookups by shelter should not scan the tables.
+    '''
+    seed(Prefs.schedule.service_day())
+    for statement in (
+        'SELECT day FROM counts WHERE shelter_id = %(id)s',
+        'SELECT 1 FROM logs WHERE shelter_id = %(id)s'
+    ):
+        explained = plan(statement, {'id': 7})
+        assert 'Seq Scan' not in explained, statement
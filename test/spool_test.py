@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from app import db
+from app.prefs import Prefs
+from app.models import Shelter, Count, Log
+from app.twilio_api.spool import Spool
+
+down = OperationalError('SELECT 1', {}, Exception('could not connect to server'))
+
+
+@pytest.fixture
+def spool(app_with_envion_DB, test_shelters, tmp_path):
+    '''The spool in a temporary file; tests replay it themselves'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    app_with_envion_DB.config.update(
+        SPOOL_PATH=str(tmp_path / 'spool.db'),
+        SPOOL_REPLAY_INTERVAL=3600,
+        SPOOL_BATCH_SIZE=2)
+    Spool.reset()
+    Spool.start(app_with_envion_DB)
+    yield Spool
+    Spool.stop()
+    Spool.reset()
+
+
+def test_collect_spools_when_database_is_slow(app_with_envion_DB, spool, test_shelters):
+    '''A count that can't be saved within the deadline should be spooled, then replayed once'''
+    shelter = test_shelters[0]
+    app_with_envion_DB.config['TWILIO_DB_DEADLINE'] = 0.2
+    other = db.engine.connect()
+    transaction = other.begin()
+    try:
+        other.execute(text('LOCK TABLE counts IN EXCLUSIVE MODE'))
+        rv = app_with_envion_DB.test_client().post('/twilio/save_count/', data={'numberOfPeople': 12, 'shelterID': shelter['id']})
+        assert rv.get_json() == {"success": True, "count": "12"}
+        assert spool.pending() == 1
+    finally:
+        transaction.rollback()
+        other.close()
+    assert db.session.query(Count).count() == 0
+
+    assert spool.replay() == 1
+    count = db.session.query(Count).one()
+    assert (count.shelter_id, count.personcount, count.bedcount) == (shelter['id'], 12, shelter['capacity'] - 12)
+    assert db.session.query(Log).one().action == 'save_count'
+    assert spool.pending() == 0
+
+
+def test_replay_is_idempotent(app_with_envion_DB, spool, test_shelters):
+    '''An entry replayed twice should be stored once, and never replace a later count'''
+    shelter = test_shelters[0]
+    today = Prefs.schedule.service_day()
+    reported = datetime.now(timezone.utc) - timedelta(minutes=5)
+    log = {"shelter_id": shelter['id'], "action": "save_count", "parsed_text": "7", "idempotency_key": "abc"}
+    spool.put_count(shelter['id'], 7, today, log, reported)
+    spool.put_count(shelter['id'], 7, today, log, reported)
+    assert spool.replay() == 2
+    assert db.session.query(Log).count() == 1
+    assert db.session.query(Count).one().personcount == 7
+
+    app_with_envion_DB.test_client().post('/twilio/save_count/', data={'numberOfPeople': 9, 'shelterID': shelter['id']})
+    spool.put_count(shelter['id'], 3, today, dict(log, idempotency_key="def"), reported)
+    assert spool.replay() == 1
+    assert db.session.query(Count).populate_existing().one().personcount == 9
+
+
+def test_replayed_count_exported(app_with_envion_DB, spool, test_shelters, tmp_path):
+    '''A count replayed after a snapshot build should be in the next delta, though reported before it'''
+    shelter = test_shelters[0]
+    today = Prefs.schedule.service_day()
+    app_with_envion_DB.config['EXPORT_SNAPSHOT_DIR'] = str(tmp_path / 'snapshots')
+    client = app_with_envion_DB.test_client()
+    reported = datetime.now(timezone.utc) - timedelta(minutes=5)
+    client.post('/twilio/save_count/', data={'numberOfPeople': 9, 'shelterID': test_shelters[1]['id']})
+    spool.put_count(shelter['id'], 7, today, {"shelter_id": shelter['id'], "action": "save_count"}, reported)
+    client.get('/api/snapshots/build/', headers={'X-Appengine-Cron': 'true'})
+
+    assert spool.replay() == 1
+    client.get('/api/snapshots/build/', headers={'X-Appengine-Cron': 'true'})
+    manifest = client.get('/api/exportkey/export/snapshot/').get_json()
+    assert [s['rows'] for s in manifest['segments']] == [1, 1]
+    delta = client.get('/api/exportkey/export/snapshot/' + manifest['segments'][1]['file'])
+    assert delta.get_data(as_text=True).splitlines()[1].endswith(f",7,{shelter['capacity'] - 7},{shelter['id']}")
+
+
+def test_replayed_count_changes_etag(app_with_envion_DB, spool, test_shelters):
+    '''Replacing a count by replaying an earlier report should still change the board's ETag'''
+    shelter = test_shelters[0]
+    today = Prefs.schedule.service_day()
+    client = app_with_envion_DB.test_client()
+    # reported after both spooled counts
+    client.post('/twilio/save_count/', data={'numberOfPeople': 9, 'shelterID': test_shelters[1]['id']})
+    spool.put_count(shelter['id'], 7, today, {"shelter_id": shelter['id'], "action": "save_count"},
+                    datetime.now(timezone.utc) - timedelta(minutes=10))
+    spool.replay()
+    etag = client.get('/api/counts/').headers['ETag']
+
+    spool.put_count(shelter['id'], 8, today, {"shelter_id": shelter['id'], "action": "save_count"},
+                    datetime.now(timezone.utc) - timedelta(minutes=5))
+    spool.replay()
+    rv = client.get('/api/counts/', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
+def test_webhook_logs_spooled(app_with_envion_DB, spool, test_shelters):
+    '''Logs should be spooled while the database is down; rejected ones are dropped on replay'''
+    client = app_with_envion_DB.test_client()
+    with patch('app.twilio_api.logsink.limit_statement_time', side_effect=down):
+        assert client.post('/twilio/log_failed_call/', data={'shelterID': test_shelters[0]['id'], 'error': 'busy'}).get_json()['success']
+        assert client.post('/twilio/log_failed_call/', data={'shelterID': 999, 'error': 'busy'}).get_json()['success']
+        assert client.post('/twilio/validate_shelter/', data={'shelterID': test_shelters[1]['login_id']}).get_json()['success']
+    assert spool.pending() == 3
+    assert db.session.query(Log).count() == 0
+
+    assert spool.replay() == 2
+    assert sorted(log.shelter_id for log in db.session.query(Log)) == sorted(s['id'] for s in test_shelters)
+    stats = spool.stats()
+    assert (stats['pending'], stats['replayed'], stats['dropped']) == (0, 2, 1)
+
+
+def test_replay_waits_for_database(app_with_envion_DB, spool, test_shelters):
+    '''Entries should stay spooled while the database is still unavailable'''
+    spool.put_logs([{"shelter_id": test_shelters[0]['id'], "error": "busy", "idempotency_key": "abc"}])
+    with patch.object(db.session, 'execute', side_effect=down):
+        assert spool.replay() == 0
+    assert spool.pending() == 1
+    assert spool.stats()['last_error']
+
+
+def test_collect_without_spool(app_with_envion_DB, test_shelters):
+    '''Without a spool the caller should be told the count wasn't recorded'''
+    db.session.add(Shelter(**test_shelters[0]))
+    db.session.commit()
+    with patch('app.twilio_api.views.save_count', side_effect=down):
+        rv = app_with_envion_DB.test_client().post('/twilio/save_count/', data={'numberOfPeople': 12, 'shelterID': test_shelters[0]['id']})
+    assert rv.get_json()['success'] is False
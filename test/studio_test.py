@@ -0,0 +1,86 @@
+import socket
+from unittest.mock import patch
+import pytest
+from app.twilio_api.studio import StudioClient, StudioError, TokenBucket, CircuitOpen, metrics
+
+
+def routes(n):
+    return [{"To": str(i), "From": "+19073121978", "Parameters": '{"id":"%d"}' % i} for i in range(n)]
+
+
+@pytest.fixture
+def flow_url(fake_twilio):
+    metrics.reset()
+    return fake_twilio.base_url + 'testID/Executions'
+
+
+def test_client_reuses_connections(fake_twilio, flow_url):
+    '''Each worker should send all of its requests over one connection'''
+    client = StudioClient(flow_url, 'user', 'pw', max_workers=2)
+    executions = client.start_executions(routes(10))
+
+    assert [e.status for e in executions] == [201] * 10
+    assert len(fake_twilio.requests) == 10
+    assert len({address for address, _, _, _ in fake_twilio.requests}) <= 2
+    assert fake_twilio.requests[0][1] == '/v1/Flows/testID/Executions'
+    assert fake_twilio.requests[0][2] == 'Basic dXNlcjpwdw=='
+
+
+def test_client_reports_errors(fake_twilio, flow_url):
+    '''Error statuses should be returned per route without stopping the others'''
+    fake_twilio.respond = lambda form: (400 if form['To'] == '0' else 201, 0)
+    client = StudioClient(flow_url, 'user', 'pw', max_workers=1)
+    executions = client.start_executions(routes(2))
+
+    assert executions[0].status == 400
+    assert isinstance(executions[0].error, StudioError)
+    assert executions[1] == (201, None)
+
+
+def test_client_read_timeout(fake_twilio, flow_url):
+    '''A slow answer should fail the request once read_timeout has passed'''
+    fake_twilio.respond = lambda form: (201, 0.5 if form['To'] == '0' else 0)
+    client = StudioClient(flow_url, 'user', 'pw', max_workers=1, read_timeout=0.1)
+    executions = client.start_executions(routes(2))
+
+    assert isinstance(executions[0].error, socket.timeout)
+    # the timed out connection is replaced for the next request
+    assert executions[1] == (201, None)
+    assert metrics.stats()['timeouts'] == 1
+
+
+def test_circuit_breaker(fake_twilio, flow_url):
+    '''Consecutive server errors should stop the run and skip the rest'''
+    fake_twilio.respond = lambda form: (503, 0)
+    client = StudioClient(flow_url, 'user', 'pw', max_workers=1, failure_threshold=3)
+    executions = client.start_executions(routes(5))
+
+    assert len(fake_twilio.requests) == 3
+    assert all(isinstance(e.error, CircuitOpen) for e in executions[3:])
+    stats = metrics.stats()
+    assert (stats['requests'], stats['failures'], stats['skipped'], stats['circuit_opened']) == (3, 3, 2, 1)
+    assert stats['latency']['window'] == 3
+
+
+def test_circuit_breaker_ignores_bad_requests(fake_twilio, flow_url):
+    '''4xx answers are about one call, so they should not open the circuit'''
+    fake_twilio.respond = lambda form: (400, 0)
+    client = StudioClient(flow_url, 'user', 'pw', max_workers=1, failure_threshold=2)
+    client.start_executions(routes(4))
+    assert len(fake_twilio.requests) == 4
+
+
+@patch('time.sleep')
+@patch('time.monotonic')
+def test_token_bucket_waits(monotonic_mock, sleep_mock):
+    '''take() should sleep until the next token when the bucket is empty'''
+    monotonic_mock.return_value = 100.0
+    bucket = TokenBucket(rate=2)
+    bucket.take()
+    sleep_mock.assert_not_called()
+
+    def sleep(seconds):
+        monotonic_mock.return_value += seconds
+    sleep_mock.side_effect = sleep
+    bucket.take()
+    sleep_mock.assert_called_once_with(0.5)
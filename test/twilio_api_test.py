@@ -1,10 +1,14 @@
 import json
+import threading
+import time
 import pendulum
 from unittest.mock import patch
+from sqlalchemy import event, text
 from app import db
 from app.prefs import Prefs
-from app.models import Shelter, Log, Count
-import urllib.request
+from app.models import Shelter, Log, Count, DispatchRun, DispatchAttempt
+from app.twilio_api.studio import StudioClient, StudioError
+from app.twilio_api.dispatch import DISPATCH_LOCK, enqueue, claim, dispatch
 import urllib.parse
 
 from .fixtures.app_fixtures import environ
@@ -19,7 +23,7 @@ def getDataRoute(shelter):
 ##########################
 #       start_call       #
 ##########################
-@patch('urllib.request.urlopen')
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
 def test_start_call(mockObj, app_with_envion_DB, test_shelters):
     '''It should call the url to initiate the Twilio flow with the correct data'''
     test_shelter = test_shelters[0]
@@ -30,10 +34,10 @@ def test_start_call(mockObj, app_with_envion_DB, test_shelters):
     client = app_with_envion_DB.test_client()
     client.get('/twilio/start_call/')
 
-    mockObj.assert_called_with(twil_url, urllib.parse.urlencode(getDataRoute(test_shelter)).encode())
+    mockObj.assert_called_with(urllib.parse.urlencode(getDataRoute(test_shelter)).encode())
 
 
-@patch('urllib.request.urlopen')
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
 def test_start_call_inactive(mockObj, app_with_envion_DB, inactive_shelter):
     '''It should not call the url to initiate the Twilio flow for inactive shelters'''
     s2 = Shelter(**inactive_shelter)
@@ -46,7 +50,7 @@ def test_start_call_inactive(mockObj, app_with_envion_DB, inactive_shelter):
     mockObj.assert_not_called()
 
 
-@patch('urllib.request.urlopen')
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
 def test_start_call_multiple(mockObj, app_with_envion_DB, inactive_shelter, test_shelters):
     '''It should call the url to initiate the Twilio flow with the correct data for each active shelter'''
     for s in test_shelters:
@@ -59,11 +63,11 @@ def test_start_call_multiple(mockObj, app_with_envion_DB, inactive_shelter, test
     client.get('/twilio/start_call/')
 
     assert mockObj.call_count == 2
-    mockObj.assert_any_call(twil_url, urllib.parse.urlencode(getDataRoute(test_shelters[0])).encode())
-    mockObj.assert_any_call(twil_url, urllib.parse.urlencode(getDataRoute(test_shelters[1])).encode())
+    mockObj.assert_any_call(urllib.parse.urlencode(getDataRoute(test_shelters[0])).encode())
+    mockObj.assert_any_call(urllib.parse.urlencode(getDataRoute(test_shelters[1])).encode())
 
 
-@patch('urllib.request.urlopen')
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
 def test_start_call_empty_number(mockObj, app_with_envion_DB, test_shelters, shelter_no_number, shelter_empty_number):
     '''It should not try to call shelters with undefined or empty numbers'''
     for s in test_shelters:
@@ -79,11 +83,11 @@ def test_start_call_empty_number(mockObj, app_with_envion_DB, test_shelters, she
     client.get('/twilio/start_call/')
 
     assert mockObj.call_count == 2
-    mockObj.assert_any_call(twil_url, urllib.parse.urlencode(getDataRoute(test_shelters[0])).encode())
-    mockObj.assert_any_call(twil_url, urllib.parse.urlencode(getDataRoute(test_shelters[1])).encode())
+    mockObj.assert_any_call(urllib.parse.urlencode(getDataRoute(test_shelters[0])).encode())
+    mockObj.assert_any_call(urllib.parse.urlencode(getDataRoute(test_shelters[1])).encode())
 
 
-@patch('urllib.request.urlopen')
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
 def test_log_start_call(mockObj, app_with_envion_DB, test_shelters):
     '''Outgoing calls should make a log entry'''
     test_shelter = test_shelters[0]
@@ -100,7 +104,7 @@ def test_log_start_call(mockObj, app_with_envion_DB, test_shelters):
     assert logs.contact_type == "outgoing_call"
 
 
-@patch('urllib.request.urlopen')
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
 @patch('pendulum.today')
 def test_start_call_existing(pend_mock, urlopen_mock, app_with_envion_DB, test_shelters):
     '''It should only initiate calls when an existing count is not in the DB for a given date and shelter id'''
@@ -115,10 +119,10 @@ def test_start_call_existing(pend_mock, urlopen_mock, app_with_envion_DB, test_s
     client = app_with_envion_DB.test_client()
     client.get('/twilio/start_call/')
 
-    urlopen_mock.assert_called_once_with(twil_url, urllib.parse.urlencode(getDataRoute(test_shelters[1])).encode())
+    urlopen_mock.assert_called_once_with(urllib.parse.urlencode(getDataRoute(test_shelters[1])).encode())
 
 
-@patch('urllib.request.urlopen')
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
 @patch('pendulum.today')
 def test_start_call_return_true(pend_mock, urlopen_mock, app_with_envion_DB, test_shelters):
     '''It should return a true JSON result when there are no shelters to call'''
@@ -134,19 +138,276 @@ def test_start_call_return_true(pend_mock, urlopen_mock, app_with_envion_DB, tes
     client = app_with_envion_DB.test_client()
     rv = client.get('/twilio/start_call/')
     data = json.loads(rv.data)
-    assert data == {"success": True}
+    assert data['success'] is True
+    assert data['remaining'] == 0
 
 
-@patch('urllib.request.urlopen')
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
 def test_start_call_return_false(urlopen_mock, app_with_envion_DB, test_shelters):
-    '''It should return a 449 status code when there were shelters to call'''
+    '''It should return a false result while there are shelters that haven't reported'''
     test_shelter = test_shelters[0]
     s = Shelter(**test_shelter)
     db.session.add(s)
     db.session.commit()
     client = app_with_envion_DB.test_client()
     rv = client.get('/twilio/start_call/')
-    assert rv.status_code == 449
+    assert rv.status_code == 200
+    assert rv.get_json()['success'] is False
+    assert rv.get_json()['remaining'] == 1
+
+
+def test_start_call_flow_url(app_with_envion_DB):
+    '''Executions should be started on the configured flow'''
+    assert StudioClient.from_config(app_with_envion_DB.config).url == twil_url
+
+
+@patch('app.twilio_api.studio.StudioClient.post')
+def test_start_call_failed_execution(mockObj, app_with_envion_DB, test_shelters):
+    '''A failed execution request should not stop the other calls and should be logged with its error'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    failing = urllib.parse.urlencode(getDataRoute(test_shelters[0])).encode()
+
+    def post(data):
+        if data == failing:
+            raise StudioError(500, 'oops')
+        return 201
+    mockObj.side_effect = post
+
+    client = app_with_envion_DB.test_client()
+    assert client.get('/twilio/start_call/').get_json()['failed'] == 1
+    assert mockObj.call_count == 2
+    errors = {log.shelter_id: log.error for log in db.session.query(Log)}
+    assert errors == {test_shelters[0]['id']: 'Twilio returned 500: oops', test_shelters[1]['id']: None}
+
+
+@patch('app.twilio_api.studio.StudioClient.post')
+def test_start_call_retries_send_failures(mockObj, app_with_envion_DB, test_shelters):
+    '''A request Twilio didn't answer should be retried by the next invocation without using up an attempt'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    failing = urllib.parse.urlencode(getDataRoute(test_shelters[0])).encode()
+
+    def post(data):
+        if data == failing:
+            raise StudioError(503, 'busy')
+        return 201
+    mockObj.side_effect = post
+
+    client = app_with_envion_DB.test_client()
+    client.get('/twilio/start_call/')
+    # tried once per invocation, not again in the same one
+    assert mockObj.call_count == 2
+    attempt = DispatchAttempt.query.get((Prefs.schedule.service_day().date(), test_shelters[0]['id']))
+    assert (attempt.attempts, attempt.last_attempt, attempt.leased_until) == (0, None, None)
+    assert attempt.error == 'Twilio returned 503: busy'
+
+    mockObj.side_effect = None
+    mockObj.return_value = 201
+    assert client.get('/twilio/start_call/').get_json()['dialed'] == 1
+    assert mockObj.call_args[0][0] == failing
+    assert sorted(a.attempts for a in DispatchAttempt.query.populate_existing()) == [1, 1]
+
+
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
+def test_start_call_single_insert(mockObj, app_with_envion_DB, test_shelters):
+    '''All of a run's logs should be written by one INSERT'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    inserts = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO logs'):
+            inserts.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        app_with_envion_DB.test_client().get('/twilio/start_call/')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+    assert len(inserts) == 1
+    assert db.session.query(Log).count() == 2
+
+
+def test_start_call_fake_twilio(app_with_envion_DB, test_shelters, fake_twilio):
+    '''start_call should dial every shelter through the (fake) Studio API'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+
+    rv = app_with_envion_DB.test_client().get('/twilio/start_call/')
+    assert rv.get_json()['dialed'] == 2
+    assert sorted(form['To'] for _, _, _, form in fake_twilio.requests) == sorted(s['phone'] for s in test_shelters)
+    assert fake_twilio.requests[0][1] == '/v1/Flows/testID/Executions'
+
+
+def test_start_call_circuit_open(app_with_envion_DB, test_shelters, fake_twilio):
+    '''When Twilio keeps failing the shelters left should be logged as not dialed'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    fake_twilio.respond = lambda form: (500, 0)
+    app_with_envion_DB.config['TWILIO_MAX_CONCURRENCY'] = 1
+    app_with_envion_DB.config['TWILIO_FAILURE_THRESHOLD'] = 1
+
+    rv = app_with_envion_DB.test_client().get('/twilio/start_call/')
+    assert len(fake_twilio.requests) == 1
+    assert rv.get_json()['circuit_open'] is True
+    # neither call was placed, so neither counts as an attempt or stays leased
+    assert [a.attempts for a in DispatchAttempt.query] == [0, 0]
+    assert all(a.leased_until is None for a in DispatchAttempt.query)
+    errors = sorted(log.error for log in db.session.query(Log))
+    assert errors[0].startswith('Not dialed')
+    assert errors[1].startswith('Twilio returned 500')
+
+
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
+def test_start_call_redial_interval(mockObj, app_with_envion_DB, test_shelters):
+    '''Shelters should only be redialed once the redial interval has passed, up to the attempt limit'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    client = app_with_envion_DB.test_client()
+    client.get('/twilio/start_call/')
+    assert mockObj.call_count == 2
+
+    client.get('/twilio/start_call/')
+    assert mockObj.call_count == 2
+
+    db.session.execute("UPDATE dispatch_attempts SET last_attempt = now() - interval '1 hour'")
+    db.session.commit()
+    assert client.get('/twilio/start_call/').get_json()['dialed'] == 2
+    assert [a.attempts for a in DispatchAttempt.query] == [2, 2]
+
+    app_with_envion_DB.config['TWILIO_MAX_ATTEMPTS'] = 2
+    db.session.execute("UPDATE dispatch_attempts SET last_attempt = now() - interval '1 hour'")
+    db.session.commit()
+    client.get('/twilio/start_call/')
+    assert mockObj.call_count == 4
+
+
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
+def test_start_call_resumes(mockObj, app_with_envion_DB, test_shelters):
+    '''A run cut short by its time budget should continue with the shelters it hadn't dialed'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    app_with_envion_DB.config['DISPATCH_BATCH_SIZE'] = 1
+    app_with_envion_DB.config['DISPATCH_TIME_BUDGET'] = 0
+    client = app_with_envion_DB.test_client()
+
+    first = client.get('/twilio/start_call/').get_json()
+    second = client.get('/twilio/start_call/').get_json()
+    assert (first['dialed'], second['dialed']) == (1, 1)
+    dialed = [call[0][0] for call in mockObj.call_args_list]
+    assert len(set(dialed)) == 2
+
+    run = DispatchRun.query.one()
+    assert run.finished is None
+    today = Prefs.schedule.service_day()
+    for s in test_shelters:
+        db.session.add(Count(shelter_id=s['id'], personcount=1, bedcount=1, day=today.isoformat()))
+    db.session.commit()
+    assert client.get('/twilio/start_call/').get_json()['success'] is True
+    assert DispatchRun.query.populate_existing().one().finished is not None
+
+
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
+def test_start_call_skips_leased(mockObj, app_with_envion_DB, test_shelters):
+    '''Shelters leased to another invocation should be left to it until the lease runs out'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    app_with_envion_DB.config['DISPATCH_BATCH_SIZE'] = 1
+    today = Prefs.schedule.service_day()
+    enqueue(today)
+    [leased], _ = claim(today, app_with_envion_DB.config)
+
+    client = app_with_envion_DB.test_client()
+    assert client.get('/twilio/start_call/').get_json()['dialed'] == 1
+    assert mockObj.call_args[0][0] == urllib.parse.urlencode(
+        getDataRoute(next(s for s in test_shelters if s['id'] != leased.id))).encode()
+
+    db.session.execute("UPDATE dispatch_attempts SET leased_until = now() - interval '1 second'")
+    db.session.commit()
+    assert client.get('/twilio/start_call/').get_json()['dialed'] == 1
+    assert mockObj.call_count == 2
+
+
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
+def test_start_call_skips_locked(mockObj, app_with_envion_DB, test_shelters):
+    '''A batch another invocation is in the middle of claiming should be skipped, not waited for'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+    enqueue(Prefs.schedule.service_day())
+    locked_id = test_shelters[0]['id']
+
+    other = db.engine.connect()
+    transaction = other.begin()
+    try:
+        other.execute(text('SELECT 1 FROM dispatch_attempts WHERE shelter_id = :id FOR UPDATE'), id=locked_id)
+        rv = app_with_envion_DB.test_client().get('/twilio/start_call/')
+        assert rv.get_json()['dialed'] == 1
+        assert mockObj.call_args[0][0] == urllib.parse.urlencode(getDataRoute(test_shelters[1])).encode()
+    finally:
+        transaction.rollback()
+        other.close()
+
+
+def test_start_call_concurrent_rate(app_with_envion_DB, test_shelters):
+    '''Invocations running at once should keep to TWILIO_CALLS_PER_SECOND between them'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    for i in range(3, 9):
+        db.session.add(Shelter(id=i, name=f'shelter_{i}', login_id=str(i), capacity=10, phone=f'907-555-000{i}', active=True))
+    db.session.commit()
+    app_with_envion_DB.config.update(TWILIO_CALLS_PER_SECOND=10, DISPATCH_BATCH_SIZE=2)
+    today = Prefs.schedule.service_day()
+    sent = []
+    lock = threading.Lock()
+
+    def post(client, data):
+        with lock:
+            sent.append(time.monotonic())
+        return 201
+
+    def run():
+        with app_with_envion_DB.app_context():
+            dispatch(today, app_with_envion_DB.config)
+
+    with patch('app.twilio_api.studio.StudioClient.post', post):
+        dispatchers = [threading.Thread(target=run) for _ in range(2)]
+        for t in dispatchers:
+            t.start()
+        for t in dispatchers:
+            t.join()
+    assert len(sent) == 8
+    sent.sort()
+    assert min(b - a for a, b in zip(sent, sent[1:])) > 0.08
+
+
+@patch('app.twilio_api.studio.StudioClient.post', return_value=201)
+def test_start_call_enqueue_locked(mockObj, app_with_envion_DB, test_shelters):
+    '''While another invocation fills the queue, start_call should dial from the queue as it is'''
+    for s in test_shelters:
+        db.session.add(Shelter(**s))
+    db.session.commit()
+
+    other = db.engine.connect()
+    transaction = other.begin()
+    try:
+        other.execute(text('SELECT pg_advisory_xact_lock(:key, 0)'), key=DISPATCH_LOCK)
+        rv = app_with_envion_DB.test_client().get('/twilio/start_call/')
+        assert rv.get_json()['dialed'] == 0
+        assert rv.get_json()['remaining'] == 2
+    finally:
+        transaction.rollback()
+        other.close()
+    assert app_with_envion_DB.test_client().get('/twilio/start_call/').get_json()['dialed'] == 2
 
 
 ##########################
@@ -327,3 +588,35 @@ def test_validate_time_log(pend_mock, app_with_envion_DB, test_shelters):
     assert log.shelter_id == test_shelter['id']
     assert log.from_number == phone
     assert log.parsed_text == str(data['numberOfPeople'])
+
+
+def test_save_count_single_statement(app_with_envion_DB, test_shelters):
+    '''A count and its log should be written in one round trip, replacing an earlier count for the day'''
+    test_shelter = test_shelters[0]
+    db.session.add(Shelter(**test_shelter))
+    db.session.commit()
+    client = app_with_envion_DB.test_client()
+    client.post('/twilio/save_count/', data={'numberOfPeople': 90, 'shelterID': test_shelter['id']})
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if 'counts' in statement or 'logs' in statement:
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        rv = client.post('/twilio/save_count/', data={'numberOfPeople': 75, 'shelterID': test_shelter['id']})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+    assert rv.get_json()['success'] is True
+    assert len(statements) == 1
+    count = db.session.query(Count).one()
+    assert (count.personcount, count.bedcount) == (75, test_shelter['capacity'] - 75)
+    assert db.session.query(Log).count() == 2
+
+
+def test_save_count_unknown_shelter(app_with_envion_DB, test_shelters):
+    '''A count for a shelter that doesn't exist should fail without writing anything'''
+    rv = app_with_envion_DB.test_client().post('/twilio/save_count/', data={'numberOfPeople': 9, 'shelterID': 999})
+    assert rv.get_json()['success'] is False
+    assert db.session.query(Count).count() == 0